@@ -10,8 +10,10 @@ any generic scripts.
 
 from abc import ABCMeta, abstractmethod, abstractproperty
 from logging import info, warning
+from math import sqrt
+from time import time
 from six import add_metaclass
-from .genie import gen
+from .genie import gen, SwitchGenie
 
 
 @add_metaclass(ABCMeta)  # pylint: disable=too-many-public-methods
@@ -20,13 +22,58 @@ class ScanningInstrument(object):
 
     _dae_mode = None
     _detector_lock = False
+    detector_cache_time = 10.0
     title_footer = ""
     measurement_type = "sans"
+    # The spectrum counted by a scan and the seconds between the
+    # position readings of a fly scan.  A fly scan gives up once the
+    # block has not moved for fly_stall seconds.
+    scan_spectrum = 5
+    fly_poll = 0.2
+    fly_stall = 10.0
+    # Counting to a precision compares the detector with this monitor
+    # and, unless told otherwise, collects between these charges
+    monitor_spectrum = 1
+    precision_min_uamps = 1.0
+    precision_max_uamps = 100.0
+    settle_conditions = {}
+    # If quicklook is set, the transmission of every sample is found
+    # from the monitors at the end of the run and compared with the
+    # last blank.  Each instrument gives the flight paths to its
+    # monitors, in metres.
+    quicklook = False
+    trans_spectrum = 4
+    monitor_lengths = {}
+    quicklook_wavelengths = (1.0, 12.0, 22)
+    _quicklook_blank = None
+    # If beam_watch is set, timed measurements are paused whenever the
+    # current read from beam_pv falls below beam_threshold and the
+    # time spent paused is added on to the measurement.  The beam is
+    # checked every beam_poll seconds, and a measurement gives up if
+    # the beam stays off for beam_max_wait seconds.  Every
+    # measurement adds its counting and lost seconds to beam_record.
+    beam_watch = False
+    beam_pv = "AC:TS2:BEAM:CURR"
+    beam_threshold = 1.0
+    beam_poll = 1.0
+    beam_max_wait = 8 * 3600.0
+    beam_record = {"counted": 0.0, "lost": 0.0}
+    # The blocks and PVs read in one request before every measurement.
+    # The values are logged, kept in last_snapshot, and saved with the
+    # rows of a measure_file checkpoint.
+    snapshot_blocks = []
+    snapshot_pvs = []
+    last_snapshot = {}
+    # The journal keeps the measurement type, label, and id in EPICS
+    # string PVs, which hold at most this many characters.
+    journal_length = 40
+    _measurement_id = ""
     _TIMINGS = ["uamps", "frames", "seconds", "minutes", "hours"]
 
     def __init__(self):
         self.setup_sans = self.setup_dae_event
         self.setup_trans = self.setup_dae_transmission
+        self._detector_cache = {}
 
     def set_default_dae(self, mode=None, trans=False):
         """Set the default DAE mode for SANS or TRANS measuremnts.
@@ -106,6 +153,46 @@ class ScanningInstrument(object):
         if gen.get_runstate() != "SETUP":  # pragma: no cover
             raise RuntimeError("Cannot start a measurement in a measurement")
 
+    def _check_journal(self, field, value):
+        """Refuse a journal value which the PV would cut short.
+
+        This is for values which the reduction has to read back in
+        full, such as the labels of a packed run.
+
+        Parameters
+        ==========
+        field : str
+          The name of the journal entry, e.g. "label"
+        value : str
+          The value to be written
+        """
+        if len(str(value)) > self.journal_length:
+            raise ValueError(
+                "The measurement {} \"{}\" is longer than {} "
+                "characters".format(field, value, self.journal_length))
+
+    def _fit_journal(self, field, value):
+        """Cut a journal value to the length which the PV holds.
+
+        Parameters
+        ==========
+        field : str
+          The name of the journal entry, e.g. "label"
+        value : str
+          The value to be written
+
+        Returns
+        =======
+        The value, shortened with a warning if it would not fit.
+        """
+        if len(value) > self.journal_length:
+            warning("The measurement {} \"{}\" is longer than {} characters, "
+                    "so only \"{}\" will be recorded".format(
+                        field, value, self.journal_length,
+                        value[:self.journal_length]))
+            value = value[:self.journal_length]
+        return value
+
     @abstractmethod
     def set_measurement_type(self, value):  # pragma: no cover
         """Set the measurement type in the journal.
@@ -118,7 +205,8 @@ class ScanningInstrument(object):
         This function should perform no physical changes to the
         beamline.  The only change should be in the MEASUREMENT:TYPE
         value stored in the journal for the next run, which should be
-        set to the new value.
+        set to the new value.  A value longer than ``journal_length``
+        is cut short with a warning.
         """
         pass  # pragma: no cover
 
@@ -134,7 +222,8 @@ class ScanningInstrument(object):
         This function should perform no physical changes to the
         beamline.  The only change should be in the MEASUREMENT:LABEL
         value stored in the journal for the next run, which should be
-        set to the new value.
+        set to the new value.  A value longer than ``journal_length``
+        is cut short with a warning.
         """
         pass  # pragma: no cover
 
@@ -150,7 +239,10 @@ class ScanningInstrument(object):
         This function should perform no physical changes to the
         beamline.  The only change should be in the MEASUREMENT:ID
         value stored in the journal for the next run, which should be
-        set to the new value.
+        set to the new value.  A value longer than ``journal_length``
+        is cut short with a warning.  The value is also kept in
+        ``_measurement_id``, so that a measurement which changes the
+        id can put it back.
         """
         pass
 
@@ -223,7 +315,7 @@ class ScanningInstrument(object):
     def _end(self):
         """End a measurement."""
         if self._dae_mode and hasattr(self, "_end_"+self._dae_mode):
-            getattr(self, "_end_"+self._dae_mode)()  # pragma: no cover
+            getattr(self, "_end_"+self._dae_mode)()
         else:
             gen.end()
 
@@ -231,9 +323,160 @@ class ScanningInstrument(object):
         """Await the user's desired statistics."""
         if self._dae_mode and hasattr(self, "_waitfor_"+self._dae_mode):
             getattr(self, "_waitfor_"+self._dae_mode)(**kwargs)
+        elif self.beam_watch and [k for k in ["seconds", "minutes", "hours"]
+                                  if k in kwargs]:
+            self._waitfor_beam(**kwargs)
         else:
             gen.waitfor(**kwargs)
 
+    def take_snapshot(self):
+        """Read and log the blocks and PVs in the snapshot lists.
+
+        Returns
+        -------
+        dict
+          The value of every block and PV, which is also kept in
+          ``last_snapshot``
+
+        """
+        from .Util import snapshot
+        if not self.snapshot_blocks and not self.snapshot_pvs:
+            return {}
+        self.last_snapshot = snapshot(self.snapshot_blocks, self.snapshot_pvs)
+        info("Instrument state: " + ", ".join(
+            ["{}={}".format(k, self.last_snapshot[k])
+             for k in sorted(self.last_snapshot)]))
+        return self.last_snapshot
+
+    def beam_on(self):
+        """Whether the proton beam is on.
+
+        Returns None if the beam current cannot be read.
+        """
+        try:
+            current = gen.get_pv(self.beam_pv)
+        except Exception:  # pylint: disable=broad-except
+            return None
+        if current is None:
+            return None
+        return float(current) >= self.beam_threshold
+
+    def _waitfor_beam(self, seconds=0, minutes=0, hours=0):
+        """Count for a time with the beam on.
+
+        The run is paused as soon as the beam is seen to be off, and
+        the time without beam, measured on the instrument clock, is
+        added on to the measurement.  Measurements in frames or uamps
+        need no help, since the DAE only counts frames with beam.
+        """
+        from .Util import instrument_time
+        target = seconds + 60 * minutes + 3600 * hours
+        counted = 0.0
+        lost = 0.0
+        unknown = False
+        while counted < target:
+            state = self.beam_on()
+            if state is None and not unknown:
+                warning("Cannot read the beam current from {}, so the "
+                        "beam is assumed to be on".format(self.beam_pv))
+                unknown = True
+            if state is not False:
+                start = instrument_time()
+                gen.waitfor(seconds=min(self.beam_poll, target - counted))
+                counted += instrument_time() - start
+                continue
+            gen.pause()
+            info("The beam is off, so the run is paused")
+            start = instrument_time()
+            while self.beam_on() is False:
+                if instrument_time() - start > self.beam_max_wait:
+                    raise RuntimeError(
+                        "The beam has been off for over {:.0f}s.  The run "
+                        "is still paused.".format(self.beam_max_wait))
+                gen.waitfor(seconds=self.beam_poll)
+            outage = instrument_time() - start
+            gen.resume()
+            info("The beam returned after {:.0f}s, so the run has "
+                 "resumed".format(outage))
+            lost += outage
+        self.beam_record = {"counted": self.beam_record["counted"] + counted,
+                            "lost": self.beam_record["lost"] + lost}
+        if lost:
+            info("Added {:.0f}s to the measurement for the time without "
+                 "beam".format(lost))
+
+    def beam_summary(self):
+        """Total the beam lost by every watched measurement.
+
+        Returns
+        -------
+        dict
+          The seconds ``counted`` with beam, the seconds ``lost`` to
+          outages, and the ``efficiency``, which is the fraction of
+          the time that the beam was on.
+
+        """
+        result = dict(self.beam_record)
+        total = result["counted"] + result["lost"]
+        result["efficiency"] = result["counted"] / total if total else 1.0
+        return result
+
+    def relative_error(self, roi=None):
+        """The relative error on the normalised counts of the current run.
+
+        Parameters
+        ----------
+        roi : list of int
+          The spectra in the region of interest.  By default, the
+          whole detector is used.
+
+        Returns
+        -------
+        float
+          The relative Poisson error of the detector counts divided by
+          the counts in ``monitor_spectrum``.
+
+        """
+        if roi is None:
+            counts = gen.get_totalcounts()
+        else:
+            counts = sum([gen.integrate_spectrum(spectrum)
+                          for spectrum in roi])
+        monitor = gen.integrate_spectrum(self.monitor_spectrum)
+        if counts <= 0 or monitor <= 0:
+            return float("inf")
+        return sqrt(1.0 / counts + 1.0 / monitor)
+
+    def _waitfor_precision(self, precision, uamps=None, min_uamps=None,
+                           roi=None):
+        """Count until the region of interest reaches a relative error.
+
+        After the minimum charge, the charge needed is predicted from
+        the current error, which falls with the square root of the
+        charge, so that only a few checks are needed.  The run stops
+        at the maximum charge whatever the error.
+        """
+        if uamps is None:
+            uamps = self.precision_max_uamps
+        target = self.precision_min_uamps if min_uamps is None \
+            else min_uamps
+        while True:
+            gen.waitfor(uamps=min(target, uamps))
+            charge = gen.get_uamps()
+            error = self.relative_error(roi)
+            if error <= precision:
+                info("Reached a relative error of {:.2g} after {:.3g} "
+                     "uamps".format(error, charge))
+                return
+            if charge >= uamps:
+                info("Stopping at {:.3g} uamps with a relative error of "
+                     "{:.2g}".format(charge, error))
+                return
+            if error == float("inf"):
+                target = 2 * max(charge, target)
+            else:
+                target = 1.02 * charge * (error / precision) ** 2
+
     @staticmethod
     @abstractmethod
     def set_aperature(size):  # pragma: no cover
@@ -289,11 +532,49 @@ class ScanningInstrument(object):
             if self.detector_lock():
                 raise RuntimeError("The instrument scientist has locked the"
                                    " detector state")
+            self.detector_cache_clear()
             if powered is True:
                 self._detector_turn_on(delay=delay)
             else:
                 self._detector_turn_off(delay=delay)
-        return self._detector_is_on()
+            self.detector_cache_clear()
+        return self._detector_cached_state()
+
+    def detector_cache_clear(self):
+        """Forget the cached detector state.
+
+        The next call to :py:meth:`detector_on` will read the status
+        PVs from the instrument again.  This is performed
+        automatically whenever the detector is turned on or off, but
+        can be called by hand if the detector has been changed from
+        outside the script.
+
+        """
+        self._detector_cache = {}
+
+    def _detector_cached_state(self):
+        """Determine the detector state without repeating recent reads.
+
+        The status PVs are only read if the last reading is older
+        than ``detector_cache_time`` seconds.  Each genie backend is
+        cached separately, so that validating a script cannot hide the
+        state of the real detector.
+
+        Returns
+        -------
+        bool
+          True if the detector is powered up.
+
+        """
+        backend = SwitchGenie.target()
+        now = time()
+        if backend in self._detector_cache:
+            stamp, state = self._detector_cache[backend]
+            if now - stamp < self.detector_cache_time:
+                return state
+        state = self._detector_is_on()
+        self._detector_cache[backend] = (now, state)
+        return state
 
     @staticmethod
     @abstractmethod
@@ -356,23 +637,58 @@ class ScanningInstrument(object):
         blank : bool
           Is this a measurement on a sample blank
         """
+        self.set_measurement_type(self._measurement_kind(trans, blank))
         if trans:
-            if blank:
-                self.set_measurement_type("blank_transmission")
-            else:
-                self.set_measurement_type("transmission")
             self.setup_trans()
             self._configure_trans_custom()
         else:
-            if blank:
-                self.set_measurement_type("blank")
-            else:
-                self.set_measurement_type(self.measurement_type)
             self.setup_sans()
             self._configure_sans_custom()
 
+    def _measurement_kind(self, trans, blank):
+        """The measurement type recorded in the journal."""
+        if trans:
+            if blank:
+                return "blank_transmission"
+            return "transmission"
+        if blank:
+            return "blank"
+        return self.measurement_type
+
+    def _move_sample(self, pos, kwargs):
+        """Start moving to a sample position and any requested blocks.
+
+        Parameters
+        ==========
+        pos
+          The sample changer position, a function which moves to the
+          position, or None to stay in the current position.
+        kwargs : dict
+          The measurement parameters.  Any which are not timings are
+          block names and positions.
+        """
+        if pos:
+            if isinstance(pos, str):
+                if self.check_move_pos(pos=pos):
+                    info("Moving to sample changer position {}".format(pos))
+                    gen.cset(SamplePos=pos)
+                else:
+                    raise RuntimeError(
+                        "Position {} does not exist".format(pos))
+            elif callable(pos):
+                info("Moving to position {}".format(pos.__name__))
+                pos()
+            else:
+                raise TypeError("Cannot understand position {}".format(pos))
+        for arg in kwargs:
+            if arg in self.TIMINGS:
+                continue
+            info("Moving {} to {}".format(arg, kwargs[arg]))
+            gen.cset(arg, kwargs[arg])
+
     def measure(self, title, pos=None, thickness=1.0, trans=False,
-                dae=None, blank=False, aperature="", **kwargs):
+                dae=None, blank=False, aperature="", precision=None,
+                min_uamps=None, roi=None, **kwargs):
         """Take a sample measurement.
 
         Parameters
@@ -410,6 +726,15 @@ class ScanningInstrument(object):
           changed.
         blank : bool
           If this sample should be considered a blank/can/solvent measurement
+        precision : float
+          If given, the run continues until the counts reach this
+          relative error, taking between ``min_uamps`` and ``uamps``
+          of charge.
+        min_uamps : float
+          The least charge to collect when counting to a precision
+        roi : list of int
+          The spectra counted when finding the precision.  The default
+          is the whole detector.
         **kwargs
           This function takes two kinds of keyword arguments.  If
           given a block name, it will move that block to the given
@@ -434,6 +759,8 @@ class ScanningInstrument(object):
 
         """
         self._needs_setup()
+        if precision is None and (min_uamps is not None or roi is not None):
+            raise ValueError("min_uamps and roi need a precision")
         if not self.detector_lock() and not self.detector_on() and not trans:
             raise RuntimeError(
                 "The detector is off.  Either turn on the detector or "
@@ -443,38 +770,335 @@ class ScanningInstrument(object):
         self._setup_measurement(trans, blank)
         self.set_measurement_label(title)
         self.set_aperature(aperature)
-        if pos:
-            if isinstance(pos, str):
-                if self.check_move_pos(pos=pos):
-                    info("Moving to sample changer position {}".format(pos))
-                    gen.cset(SamplePos=pos)
-                else:
-                    raise RuntimeError(
-                        "Position {} does not exist".format(pos))
-            elif callable(pos):
-                info("Moving to position {}".format(pos.__name__))
-                pos()
-            else:
-                raise TypeError("Cannot understand position {}".format(pos))
-        for arg in kwargs:
-            if arg in self.TIMINGS:
-                continue
-            info("Moving {} to {}".format(arg, kwargs[arg]))
-            gen.cset(arg, kwargs[arg])
+        self._move_sample(pos, kwargs)
         times = self.sanitised_timings(kwargs)
+        if precision is not None and self._dae_mode and \
+           hasattr(self, "_waitfor_"+self._dae_mode):
+            raise ValueError("Cannot count to a precision in {} mode".format(
+                self._dae_mode))
         gen.waitfor_move()
         gen.change_sample_par("Thick", thickness)
         info("Using the following Sample Parameters")
         self.printsamplepars()
         gen.change(title=title+self.title_footer)
+        self.take_snapshot()
 
         self._begin()
-        info("Measuring {title:} for {time:} {units:}".format(
-            title=title+self.title_footer,
-            units=list(times.keys())[0],
-            time=times[list(times.keys())[0]]))
-        self._waitfor(**times)
+        if precision is not None:
+            info("Measuring {title:} to a relative error of {error:}".format(
+                title=title+self.title_footer, error=precision))
+            self._waitfor_precision(precision, times.get("uamps"),
+                                    min_uamps, roi)
+        else:
+            units = [k for k in self.TIMINGS if k in times][0]
+            info("Measuring {title:} for {time:} {units:}".format(
+                title=title+self.title_footer, units=units,
+                time=times[units]))
+            self._waitfor(**times)
+        spectra = None
+        if trans and self.quicklook and not SwitchGenie.MOCKING_MODE:
+            from .quicklook import live_spectra
+            # Stop counting, so that both monitors cover the same frames
+            if gen.get_runstate() == "RUNNING":
+                gen.pause()
+            spectra = live_spectra([self.monitor_spectrum,
+                                    self.trans_spectrum])
         self._end()
+        if spectra is not None:
+            if blank:
+                self._quicklook_blank = spectra
+            elif self._quicklook_blank:
+                self.quicklook_trans(title, spectra)
+
+    def quicklook_trans(self, title, sample=None, blank=None):
+        """Log the transmission of a sample against its blank.
+
+        Parameters
+        ----------
+        title : str
+          The name of the sample
+        sample, blank
+          The monitor spectra of the runs, or the paths of their NeXus
+          files.  The sample defaults to the current run and the blank
+          to the last blank transmission measured with ``quicklook``
+          set.
+
+        Returns
+        -------
+        float
+          The average transmission
+
+        """
+        import numpy as np
+        from .quicklook import live_spectra, nexus_spectra, summarise, \
+            transmission
+        spectra = [self.monitor_spectrum, self.trans_spectrum]
+        if sample is None:
+            sample = live_spectra(spectra)
+        elif isinstance(sample, str):
+            sample = nexus_spectra(sample, spectra)
+        if blank is None:
+            blank = self._quicklook_blank
+        elif isinstance(blank, str):
+            blank = nexus_spectra(blank, spectra)
+        if blank is None:
+            raise RuntimeError("There is no blank to compare against")
+        missing = [x for x in spectra if x not in self.monitor_lengths]
+        if missing:
+            raise RuntimeError("The flight path to spectrum {} is not in "
+                               "monitor_lengths".format(missing[0]))
+        wavelength, trans, error = transmission(
+            sample, blank, self.monitor_spectrum, self.trans_spectrum,
+            self.monitor_lengths, np.linspace(*self.quicklook_wavelengths))
+        return summarise(title, wavelength, trans, error)
+
+    def measure_packed(self, measurements, title=None, thickness=1.0,
+                       trans=False, dae=None, aperature="", **kwargs):
+        """Record several short measurements as the periods of one run.
+
+        Every measurement is counted in its own DAE period.  The run is
+        paused while the sample moves between measurements, so the
+        run is only started and saved once.  The journal entry of the
+        run lists the label and type of each period, separated by
+        ``|``, which :py:mod:`src.reduction` splits back into the
+        individual measurements.  The types are abbreviated as in
+        :py:data:`src.reduction.PACKED_KINDS`, but the labels must
+        still fit in the journal together.
+
+        Parameters
+        ==========
+        measurements : list of dict
+          The parameters for each measurement.  Each needs a
+          ``title``, and may give a ``pos``, a ``blank`` flag, a run
+          time and blocks to move, as for :py:meth:`measure`.
+        title : str
+          The title of the run.  By default, this lists the titles of
+          the measurements.
+        thickness : float
+          The sample thickness recorded for the run
+        trans : bool
+          Whether the measurements are transmissions
+        dae : str or func
+          The DAE mode, as for :py:meth:`measure`
+        aperature : str
+          The aperature size, as for :py:meth:`measure`
+        **kwargs
+          Default parameters for every measurement, such as the run
+          time.
+
+        Examples
+        ========
+
+        >>> measure_packed([{"title": "Air", "blank": True, "pos": "AT"},
+        ...                 {"title": "H2O", "pos": "BT"},
+        ...                 {"title": "D2O", "pos": "CT"}],
+        ...                trans=True, frames=600)
+
+        Measure three transmissions in a single run.
+
+        """
+        from .reduction import PACKED_KINDS
+        self._needs_setup()
+        if not self.detector_lock() and not self.detector_on() and not trans:
+            raise RuntimeError(
+                "The detector is off.  Either turn on the detector or "
+                "use the detector_lock(True) to indicate that the detector "
+                "is off intentionally")
+        rows = []
+        for measurement in measurements:
+            row = dict(kwargs)
+            row.update(measurement)
+            rows.append(row)
+        labels = [row.pop("title") for row in rows]
+        kinds = [self._measurement_kind(trans, row.pop("blank", False))
+                 for row in rows]
+        kinds = "|".join([PACKED_KINDS.get(kind, kind) for kind in kinds])
+        self._check_journal("type", kinds)
+        self._check_journal("label", "|".join(labels))
+        for row in rows:
+            if [key for key in ["precision", "min_uamps", "roi"]
+                    if key in row]:
+                raise ValueError("Cannot count to a precision in a packed run")
+            if not [key for key in self.TIMINGS if key in row]:
+                raise ValueError("No run time given for a packed measurement")
+        self.set_default_dae(dae, trans)
+        self._setup_measurement(trans, False)
+        if self._dae_mode and (hasattr(self, "_begin_"+self._dae_mode) or
+                               hasattr(self, "_waitfor_"+self._dae_mode)):
+            raise ValueError("Cannot pack measurements in {} mode".format(
+                self._dae_mode))
+        self.set_measurement_type(kinds)
+        self.set_measurement_label("|".join(labels))
+        self.set_aperature(aperature)
+        gen.change_sample_par("Thick", thickness)
+        if title is None:
+            title = ", ".join(labels)
+        gen.change(title=title+self.title_footer)
+        gen.change(nperiods=len(rows))
+        try:
+            gen.begin(paused=1)
+            for period, (label, row) in enumerate(zip(labels, rows), 1):
+                self._move_sample(row.pop("pos", None), row)
+                gen.waitfor_move()
+                times = self.sanitised_timings(row)
+                units = [k for k in self.TIMINGS if k in times][0]
+                info("Measuring {} in period {} for {} {}".format(
+                    label, period, times[units], units))
+                if "frames" in times:
+                    times["frames"] += gen.get_frames()
+                if "uamps" in times:
+                    times["uamps"] += gen.get_uamps()
+                gen.change(period=period)
+                gen.resume()
+                gen.waitfor(**times)
+                gen.pause()
+            gen.end()
+        finally:
+            # The DAE now has a period for each row, so it must be set
+            # up again before the next measurement.
+            self._dae_mode = None
+
+    def measure_kinetic(self, title, pos=None, slices=None, thickness=1.0,
+                        dae=None, blank=False, aperature="", **kwargs):
+        """Take a measurement divided into time slices.
+
+        Each slice is recorded in its own DAE period of a single run.
+        The run keeps counting while the period changes, so the only
+        gap between slices is the period switch.  The planned slices
+        are recorded in the measurement id of the journal as
+        "kinetic:", the units, ":", and a comma separated list of
+        lengths, where "5*20" stands for twenty slices of five.  The
+        previous id is restored once the run has ended.
+
+        Parameters
+        ==========
+        title : str
+          The title for the measurement
+        pos
+          The sample position, as for :py:meth:`measure`
+        slices : int
+          The number of equal slices.  This is not needed if the
+          length of each slice is given as a list.
+        thickness, dae, blank, aperature
+          As for :py:meth:`measure`
+        **kwargs
+          The length of each slice, in any of the units that
+          :py:meth:`measure` accepts except ``precision``.  This is
+          either a single number or a list with a length for every
+          slice.  Slices in seconds, minutes, or hours follow the
+          clock from the start of the run, while slices in frames or
+          uamps follow the total collected.  Other keywords move
+          blocks, as for :py:meth:`measure`.
+
+        Returns
+        =======
+        list
+          The measured boundaries of the slices, starting at zero.
+
+        Examples
+        ========
+
+        >>> measure_kinetic("Jump", slices=20, seconds=5)
+
+        Count for 100 seconds in 5 second slices.
+
+        >>> measure_kinetic("Mix", frames=[10, 10, 20, 40, 80, 160])
+
+        Count in slices of increasing length.
+
+        """
+        self._needs_setup()
+        if not self.detector_lock() and not self.detector_on():
+            raise RuntimeError(
+                "The detector is off.  Either turn on the detector or "
+                "use the detector_lock(True) to indicate that the detector "
+                "is off intentionally")
+        units = [k for k in ["seconds", "minutes", "hours", "frames", "uamps"]
+                 if k in kwargs]
+        if len(units) != 1:
+            raise ValueError("A kinetic measurement needs one slice length")
+        units = units[0]
+        lengths = kwargs[units]
+        if not isinstance(lengths, (list, tuple)):
+            if slices is None:
+                raise ValueError("The number of slices is needed")
+            lengths = [lengths] * slices
+        elif slices is not None and slices != len(lengths):
+            raise ValueError("{} slices were requested, but {} lengths "
+                             "were given".format(slices, len(lengths)))
+        plan = self._kinetic_id(units, lengths)
+        self._check_journal("id", plan)
+        self.set_default_dae(dae)
+        self._setup_measurement(False, blank)
+        if self._dae_mode and (hasattr(self, "_begin_"+self._dae_mode) or
+                               hasattr(self, "_waitfor_"+self._dae_mode)):
+            raise ValueError("Cannot slice a measurement in {} mode".format(
+                self._dae_mode))
+        self.set_measurement_label(title)
+        self.set_aperature(aperature)
+        self._move_sample(pos, kwargs)
+        gen.waitfor_move()
+        gen.change_sample_par("Thick", thickness)
+        info("Using the following Sample Parameters")
+        self.printsamplepars()
+        gen.change(title=title+self.title_footer)
+        gen.change(nperiods=len(lengths))
+        previous = self._measurement_id
+        self.set_measurement_id(plan)
+        try:
+            gen.begin()
+            info("Measuring {} in {} slices of {} {}".format(
+                title+self.title_footer, len(lengths),
+                lengths[0] if len(set(lengths)) == 1 else "up to {}".format(
+                    max(lengths)),
+                units))
+            boundaries = self._kinetic_slices(units, lengths)
+            gen.end()
+        finally:
+            self.set_measurement_id(previous)
+            # The DAE now has a period for each slice, so it must be set
+            # up again before the next measurement.
+            self._dae_mode = None
+        return boundaries
+
+    @staticmethod
+    def _kinetic_id(units, lengths):
+        """The journal id for a series of slices."""
+        groups = []
+        for length in lengths:
+            if groups and groups[-1][0] == length:
+                groups[-1][1] += 1
+            else:
+                groups.append([length, 1])
+        return "kinetic:{}:{}".format(units, ",".join(
+            ["{:g}".format(length) if count == 1 else
+             "{:g}*{}".format(length, count) for length, count in groups]))
+
+    @staticmethod
+    def _kinetic_slices(units, lengths):
+        """Advance the periods of a running measurement on schedule."""
+        from .Util import instrument_time
+        scale = {"seconds": 1, "minutes": 60, "hours": 3600}
+        start = instrument_time()
+        planned = 0
+        boundaries = [0]
+        for period, length in enumerate(lengths, 1):
+            if units in scale:
+                planned += length * scale[units]
+                gen.waitfor(seconds=max(0, planned -
+                                        (instrument_time() - start)))
+            else:
+                planned += length
+                gen.waitfor(**{units: planned})
+            if period < len(lengths):
+                gen.change(period=period + 1)
+            if units in scale:
+                boundaries.append(round(instrument_time() - start, 3))
+            elif units == "frames":
+                boundaries.append(gen.get_frames())
+            else:
+                boundaries.append(gen.get_uamps())
+        return boundaries
 
     def do_sans(self, title, pos=None, thickness=1.0, dae=None, blank=False,
                 aperature="", **kwargs):
@@ -502,7 +1126,8 @@ of parameters accepted. """
                      dae=dae, blank=blank, aperature=aperature,
                      **kwargs)
 
-    def measure_file(self, file_path, forever=False):
+    def measure_file(self, file_path, forever=False, reorder=False,
+                     checkpoint=None, resume=False, journal=None):
         """Perform a series of measurements based on a spreadsheet
 
         The file should contain comma separated values.  Excel can
@@ -527,36 +1152,370 @@ of parameters accepted. """
           script manually stopped.  This can be useful for an
           overnight run where you want to keep measureing until the
           users return.
+        reorder : bool
+          If set to True, the instrument may change the order of the
+          measurements to reduce the time spent between them.  What
+          can be reordered depends on the instrument.
+        checkpoint : str
+          A file in which to record every completed row and the runs
+          that it produced.  In a ``forever`` plan, the file is
+          cleared at the end of each pass.
+        resume : bool
+          If set to True, skip the rows already recorded in the
+          checkpoint, so that an interrupted plan carries on from
+          where it stopped.
+        journal : str
+          The journal XML file.  When resuming, rows whose runs are
+          not in the journal are measured again.
+
+        Measurements which change a block with a settle condition (see
+        :py:meth:`set_settle_condition`) wait for the block to
+        equilibrate, while the measurements which it does not affect
+        are taken in the meantime.
 
         """
         from .Util import user_script
+        from .plan import load_plan, run_plan, read_checkpoint, \
+            write_checkpoint
+
+        def record(_row, **kwargs):
+            """Measure a row and add it to the checkpoint."""
+            before = int(gen.get_runnumber())
+            self.measure(**kwargs)
+            if checkpoint and not SwitchGenie.MOCKING_MODE:
+                write_checkpoint(
+                    checkpoint, _row, kwargs.get("title"),
+                    list(range(before, int(gen.get_runnumber()))),
+                    self.last_snapshot)
+
+        def prepare():
+            """Load the plan and choose the order of the rows.
+
+            This reads the real instrument, so it is done once before
+            the check, and both runs measure the rows in this order.
+            """
+            rows = load_plan(file_path)
+            done = {}
+            if checkpoint and resume:
+                done = read_checkpoint(checkpoint, journal)
+                if done:
+                    info("Skipping {} of {} rows already measured".format(
+                        len(done), len(rows)))
+            rows = [dict(row, _row=index) for index, row in enumerate(rows)
+                    if index not in done]
+            if reorder:
+                rows = self._order_plan(rows)
+            return rows
+
+        def perform(rows):
+            """Check and then measure the rows."""
+            @user_script
+            def inner():
+                """Actually run the script"""
+                run_plan(rows, record,
+                         [self.settle_conditions[k]
+                          for k in sorted(self.settle_conditions)])
+            inner()
 
-        @user_script
-        def inner():
-            """Actually load and run the script"""
-            import csv
-            import ast
-            with open(file_path, "rb") as csvfile:
-                reader = csv.DictReader(csvfile)
-                for row in reader:
-                    for k in row.keys():
-                        if row[k].strip() == "":
-                            del row[k]
-                        elif row[k].upper() == "TRUE":
-                            row[k] = True
-                        elif row[k].upper() == "FALSE":
-                            row[k] = False
-                        else:
-                            try:
-                                row[k] = ast.literal_eval(row[k])
-                            except ValueError:
-                                continue
-                    self.measure(**row)
         if forever:  # pragma: no cover
             while True:
-                inner()
+                perform(prepare())
+                if checkpoint:
+                    open(checkpoint, "w").close()
         else:
-            inner()
+            perform(prepare())
+
+    def measure_queue(self, directory, forever=True):
+        """Run measurements from a queue that can change as it runs.
+
+        Jobs are added to the queue with :py:func:`src.jobqueue.submit`
+        from any python session on the instrument PC, or by dropping a
+        JSON file into the inbox of the queue.  Jobs can be appended,
+        cancelled, reprioritised, or moved while a measurement counts.
+        See :py:mod:`src.jobqueue` for the commands.  Each job is run
+        through the simulator before it is measured, and a job which
+        fails the check is skipped.
+
+        Parameters
+        ----------
+        directory : str
+          The directory which holds the queue
+        forever : bool
+          If True, keep waiting for new jobs when the queue is empty.
+          If False, return once every job is done.
+
+        """
+        from .jobqueue import MeasurementQueue
+        MeasurementQueue(directory, self.measure,
+                         validate=self._check_measure).run(forever)
+
+    def _check_measure(self, **kwargs):
+        """Check a measurement against the mock instrument."""
+        from .Util import dry_run
+        mode = self._dae_mode
+        try:
+            dry_run(self.measure, **kwargs)
+        finally:
+            self._dae_mode = mode
+
+    def set_settle_condition(self, block, tolerance=0.1, hold=60.0,
+                             positions=None, readback=None, timeout=3600.0):
+        """Declare that a block needs time to equilibrate.
+
+        Parameters
+        ----------
+        block : str
+          The setpoint block, e.g. "Julabo1_SP"
+        tolerance : float or None
+          How close the readback must be to the setpoint.  If None,
+          the condition on the block is removed.
+        hold : float
+          How many seconds the readback must stay within tolerance
+        positions : list of str
+          The sample changer positions affected by the block.  If
+          None, every position is affected.
+        readback : str
+          The block which reports the value reached.  This defaults to
+          the setpoint block.
+        timeout : float
+          The longest time to wait for the block to settle
+
+        Examples
+        --------
+
+        >>> set_settle_condition("Julabo1_SP", tolerance=0.2, hold=300,
+        ...                      positions=["AT", "BT", "CT"],
+        ...                      readback="Julabo1_Temp")
+
+        """
+        from .plan import Settle
+        conditions = dict(self.settle_conditions)
+        if tolerance is None:
+            conditions.pop(block, None)
+        else:
+            conditions[block] = Settle(
+                block, readback=readback, tolerance=tolerance, hold=hold,
+                positions=positions, timeout=timeout)
+        self.settle_conditions = conditions
+
+    def _order_plan(self, rows):  # pylint: disable=no-self-use
+        """Rearrange a plan to reduce the dead time between measurements.
+
+        Parameters
+        ----------
+        rows : list
+          The keyword arguments for each measurement
+
+        Returns
+        -------
+        list
+          The keyword arguments in their new order
+
+        The default instrument keeps the original order, but other
+        instruments can override this to group measurements that
+        share an expensive setup.
+        """
+        return rows
+
+    def scan(self, title, block, points, fly=False, dae="scanning",
+             spectrum=None, **kwargs):
+        """Count at a series of positions of a block in a single run.
+
+        Parameters
+        ----------
+        title : str
+          The title of the run
+        block : str
+          The name of the block to scan
+        points : array_like
+          The positions at which to count
+        fly : bool
+          If False, the block stops at each point and every point is
+          counted in its own DAE period.  If True, the block moves
+          steadily from the first point to the last while the run
+          counts, and the counts are binned by the readback of the
+          block.  The points of a fly scan must be evenly ordered.
+        dae : str or function
+          The DAE mode for the scan.  Unlike :py:meth:`measure`, this
+          does not change the default mode.
+        spectrum : int
+          The spectrum to count.  The default is ``scan_spectrum``.
+        **kwargs
+          The time to count at each point of a step scan, in the
+          same form as :py:meth:`measure`.  Other keywords move blocks
+          before the scan begins.
+
+        Returns
+        -------
+        numpy.ndarray
+          The counts per frame at each point.
+
+        Examples
+        --------
+
+        >>> scan("Height", "CoarseZ", np.linspace(-5, 5, 11), frames=100)
+
+        Count for 100 frames at each millimetre of sample height.
+
+        >>> scan("Height", "CoarseZ", np.linspace(-5, 5, 11), fly=True)
+
+        Count while the sample moves through the same range.
+
+        """
+        import numpy as np
+        points = np.asarray(points, dtype=float)
+        times = self.sanitised_timings(kwargs)
+        if not fly and not times:
+            raise ValueError("A step scan needs a time to count at each "
+                             "point")
+        if spectrum is None:
+            spectrum = self.scan_spectrum
+        self._needs_setup()
+        if isinstance(dae, str):
+            dae = getattr(self, "setup_dae_" + dae)
+        dae()
+        self.set_measurement_type("scan")
+        self.set_measurement_label(title)
+        self._move_sample(None, kwargs)
+        gen.cset(block, points[0])
+        gen.waitfor_move()
+        gen.change(title=title)
+        info("Scanning {} over {} points from {} to {}".format(
+            block, len(points), points[0], points[-1]))
+        if fly:
+            return self._fly_scan(block, points, spectrum)
+        return self._step_scan(block, points, spectrum, times)
+
+    def find_centre(self, title, block, centre, width, tolerance,
+                    points=5, dip=False, passes=10, **kwargs):
+        """Find the centre of a peak or dip with a series of scans.
+
+        Each scan covers the current range with a few points and
+        finds the centroid of the counts.  The next scan is centred on
+        the centroid and spans one step of the last scan either side of
+        it, so the range narrows until the steps are within the
+        tolerance.
+
+        Parameters
+        ----------
+        title : str
+          The title of the scan runs
+        block : str
+          The block to move
+        centre : float
+          The expected position of the centre
+        width : float
+          The range of the first scan
+        tolerance : float
+          The largest acceptable step between points in the last scan
+        points : int
+          The number of points in each scan.  This must be at least
+          three.
+        dip : bool
+          Whether to find the centre of a dip in the counts, rather
+          than a peak.
+        passes : int
+          The most scans to try before giving up
+        **kwargs
+          Further parameters for :py:meth:`scan`, such as the time to
+          count at each point.
+
+        Returns
+        -------
+        float
+          The position of the centre
+
+        """
+        import numpy as np
+        if points < 3:
+            raise ValueError("Finding a centre needs at least three points")
+        if tolerance <= 0:
+            raise ValueError("The tolerance must be positive")
+        for _ in range(passes):
+            grid = np.linspace(centre - width / 2.0, centre + width / 2.0,
+                               points)
+            rates = self.scan(title, block, grid, **kwargs)
+            weights = rates.max() - rates if dip else rates - rates.min()
+            if not weights.sum():
+                raise RuntimeError(
+                    "No {} found in {} between {} and {}".format(
+                        "dip" if dip else "peak", block, grid[0], grid[-1]))
+            centre = float(np.sum(grid * weights) / weights.sum())
+            step = width / (points - 1.0)
+            if step <= tolerance:
+                return centre
+            width = 2 * step
+        raise RuntimeError(
+            "The centre of {} was not found to within {} after {} "
+            "scans".format(block, tolerance, passes))
+
+    def _step_scan(self, block, points, spectrum, times):
+        """Count each point of a scan in its own period."""
+        import numpy as np
+        gen.change(nperiods=len(points))
+        try:
+            gen.begin(paused=1)
+            frames = []
+            for index, point in enumerate(points):
+                gen.cset(block, point)
+                gen.waitfor_move()
+                gen.change(period=index + 1)
+                gen.resume()
+                target = dict(times)
+                for key in ["frames", "uamps"]:
+                    if key in target:
+                        target[key] *= index + 1
+                gen.waitfor(**target)
+                gen.pause()
+                frames.append(gen.get_frames())
+            counts = np.array(
+                [gen.integrate_spectrum(spectrum, period=index + 1)
+                 for index in range(len(points))], dtype=float)
+            gen.end()
+        finally:
+            # The DAE now has a period for each point, so it must be
+            # set up again before the next measurement.
+            self._dae_mode = None
+        frames = np.diff(np.concatenate([[0], frames]))
+        return counts / np.maximum(frames, 1)
+
+    def _fly_scan(self, block, points, spectrum):
+        """Count while a block moves, binning by its readback."""
+        import numpy as np
+        from .Util import block_value
+        steps = np.diff(points)
+        if not len(steps) or not (np.all(steps > 0) or np.all(steps < 0)):
+            raise ValueError("The points of a fly scan must be in order")
+        if steps[0] < 0:
+            return self._fly_scan(block, points[::-1], spectrum)[::-1]
+        edges = np.concatenate([[points[0] - steps[0] / 2],
+                                (points[1:] + points[:-1]) / 2,
+                                [points[-1] + steps[-1] / 2]])
+        gen.begin()
+        gen.cset(block, points[-1])
+        positions, counts, frames = [], [], []
+        last = [points[0], 0.0, 0.0]
+        still = 0.0
+        while True:
+            gen.waitfor(seconds=self.fly_poll)
+            reading = [block_value(block),
+                       float(gen.integrate_spectrum(spectrum)),
+                       float(gen.get_frames())]
+            positions.append((reading[0] + last[0]) / 2)
+            counts.append(reading[1] - last[1])
+            frames.append(reading[2] - last[2])
+            if abs(reading[0] - points[-1]) < abs(steps[-1]) / 100:
+                break
+            still = still + self.fly_poll if reading[0] == last[0] else 0.0
+            if still >= self.fly_stall:
+                warning("{} stopped at {} before reaching {}".format(
+                    block, reading[0], points[-1]))
+                break
+            last = reading
+        gen.end()
+        counts = np.histogram(positions, edges, weights=counts)[0]
+        frames = np.histogram(positions, edges, weights=frames)[0]
+        return counts / np.maximum(frames, 1)
 
     @staticmethod
     def convert_file(file_path):
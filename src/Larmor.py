@@ -1,16 +1,12 @@
 """This is the instrument implementation for the Larmor beamline."""
-from logging import info
+from logging import info, warning
+from functools import partial
+from math import ceil, log
 from .Instrument import ScanningInstrument
-from .Util import dae_setter
+from .Util import dae_setter, wait_until, block_value, snapshot, SCALES
 from .genie import gen
-
-
-def sleep(seconds):
-    """Override the sleep function to use genie.
-
-    We need this override to ensure that simularted runs are forced to
-    wait for real sleeps."""
-    return gen.waitfor(seconds=seconds)
+from .plan import bench_order, ramp_time, tune_order
+from .flipper import PeriodCycle, Step, split_frames
 
 
 class Larmor(ScanningInstrument):  # pylint: disable=too-many-public-methods
@@ -31,20 +27,111 @@ class Larmor(ScanningInstrument):  # pylint: disable=too-many-public-methods
     step = 100.0
     lrange = "0.9-13.25"
 
+    # The time taken to save a run grows with the size of the detector
+    # histogram, which holds a four byte count in every time channel
+    # of every detector spectrum, and with the events collected.
+    # choose_binning keeps the save time under save_limit seconds by
+    # picking a TOF step between tof_step_finest and tof_step_coarsest
+    # or, failing that, the log binning of fastsave_step.
+    detector_spectra = 80 * 512
+    event_bytes_rate = 2.0e5
+    save_rate = 2.0e7
+    save_limit = 60.0
+    tof_step_finest = 10.0
+    tof_step_coarsest = 500.0
+    fastsave_step = 0.1
+    tof_range = (5.0, 100000.0)
+
+    # The main detector is made of tubes side by side.  The event ids
+    # count along each tube in turn, starting from first_detector_id.
+    # The pitch is the distance in metres between tubes and between
+    # the pixels in a tube.
+    detector_shape = (80, 512)
+    detector_pitch = (0.008, 0.0012)
+    first_detector_id = 11
+    _preview = None
+
+    # The flight paths, in metres, to the incident and transmission
+    # monitors for the transmission quick look.
+    monitor_lengths = {1: 9.8, 4: 25.3}
+
+    # The chopper phases for each known wavelength range.  Blocks
+    # missing from a range are left untouched.
+    CHOPPER_PHASES = {
+        # T0 phase checked for November 2015 cycle
+        # Running at 5Hz and centering the dip from the T0 at 50ms by
+        # setting phase to 48.4ms does not stop the fast flash
+        # Setting the T0 phase to 0 (50ms) does
+        "0.9-13.25": {"T0Phase": 0, "TargetDiskPhase": 2750,
+                      "InstrumentDiskPhase": 2450},
+        "0.65-12.95": {"TargetDiskPhase": 1900,
+                       "InstrumentDiskPhase": 1600}}
+    chopper_tolerance = 5.0
+    chopper_settle_time = 120
+
+    # The longest time, in seconds, to wait for the hardware to report
+    # that it has finished.
+    detector_power_up = 180
+    detector_power_down = 60
+    bench_lift_time = 20
+    bench_tolerance = 0.05
+    beamstop_in = {"BSY": 88.5, "BSZ": 353.0}
+    beamstop_out = {"BSY": 200.0, "BSZ": 0.0}
+
+    # The adaptive SESANS split compares the counts in this spectrum
+    # for each flipper state.  A full cycle lasts at least
+    # sesans_shortest seconds and, to limit drift between the states,
+    # no more than sesans_longest seconds.  Within those limits, the
+    # cycle is kept long enough that only sesans_overhead of the beam
+    # is lost to flipping.
+    frame_rate = 10.0
+    sesans_spectrum = 4
+    sesans_shortest = 20
+    sesans_longest = 200
+    sesans_overhead = 0.02
+    flipper_cycle = None
+
+    # A polarised run records every spin state in its own period.
+    # Each state has a label, the state of the polariser flipper, and
+    # any other blocks to set, such as an analyser flipper.  Each
+    # cycle of spin_cycle frames is shared between the states in
+    # proportion to spin_ratio, which is an equal split if None.  An
+    # "auto" ratio balances the counts in spin_spectrum instead.
+    spin_states = [{"label": "Up", "flipper1": 1},
+                   {"label": "Down", "flipper1": 0}]
+    spin_ratio = None
+    spin_cycle = 2000
+    spin_spectrum = 4
+    _spin_previous_id = ""
+
+    # The speed, in units per second, of the blocks which set the echo
+    # tunes.  Blocks which are not listed move at one unit per second.
+    ramp_rates = {}
+
+    # The pi flipper controller has no status to poll, so each command
+    # is given a fixed time, in seconds, to complete.
+    pi_command_time = 1
+
     @property
     def TIMINGS(self):
         if self._dae_mode == "sesans":
             return self._TIMINGS + ["u", "d"]
+        if self._dae_mode == "polarised":
+            return self._TIMINGS + ["ratio"]
         return self._TIMINGS
 
     def set_measurement_type(self, value):
+        value = self._fit_journal("type", value)
         gen.set_pv("IN:LARMOR:PARS:SAMPLE:MEAS:TYPE", value)
 
     def set_measurement_label(self, value):
+        value = self._fit_journal("label", value)
         gen.set_pv("IN:LARMOR:PARS:SAMPLE:MEAS:LABEL", value)
 
     def set_measurement_id(self, value):
+        value = self._fit_journal("id", value)
         gen.set_pv("IN:LARMOR:PARS:SAMPLE:MEAS:ID", value)
+        self._measurement_id = value
 
     def get_lrange(self):
         """Return the current wavelength range"""
@@ -52,6 +139,7 @@ class Larmor(ScanningInstrument):  # pylint: disable=too-many-public-methods
 
     def set_lrange(self, lrange):
         """Set the current wavelength range"""
+        self.chopper_phases(lrange)
         self._dae_mode = ""
         self.lrange = lrange
 
@@ -64,6 +152,201 @@ class Larmor(ScanningInstrument):  # pylint: disable=too-many-public-methods
         self._dae_mode = ""
         self.step = step
 
+    def detector_preview(self, path, title=None, frames=None,
+                         centre=(0.0, 0.0)):
+        """Log a preview of the detector from the events of a run.
+
+        Calling this again with the same file only reads the events
+        which have arrived since, so it can be repeated while the run
+        counts.
+
+        Parameters
+        ----------
+        path : str
+          The event file.  Files ending in ".nxs" are read as NeXus
+          files, and anything else as a raw stream of detector ids.
+        title : str
+          The name to log.  This defaults to the title of the run.
+        frames : int
+          The frames counted.  This defaults to those of the run.
+        centre : tuple of float
+          The position of the beam on the detector, in metres
+
+        Returns
+        -------
+        DetectorPreview
+          The preview, which holds the image and radial profile
+
+        """
+        from .preview import DetectorPreview, EventStream, NexusEvents
+        if self._preview is None or self._preview[0] != path:
+            source = NexusEvents(path) if path.endswith(".nxs") \
+                else EventStream(path)
+            self._preview = (path, source, DetectorPreview(
+                self.detector_shape, self.first_detector_id,
+                self.detector_pitch, centre))
+        _, source, preview = self._preview
+        preview.update(source)
+        preview.summarise(title if title else gen.get_title(),
+                          frames if frames is not None else gen.get_frames())
+        return preview
+
+    @staticmethod
+    def time_channels(step, log_binning=False, low=None, high=None):
+        """Count the time channels of a time regime.
+
+        Parameters
+        ----------
+        step : float
+          The width of the channels in microseconds or, for log
+          binning, the fractional width dt/t.
+        log_binning : bool
+          Whether the channels grow logarithmically
+        low, high : float
+          The time range of the regime.  This defaults to
+          ``tof_range``.
+
+        """
+        if low is None:
+            low = Larmor.tof_range[0]
+        if high is None:
+            high = Larmor.tof_range[1]
+        if log_binning:
+            return int(ceil(log(high / low) / log(1 + step)))
+        return int(ceil((high - low) / step))
+
+    def save_time(self, step, log_binning=False, seconds=0.0, periods=1):
+        """Estimate the time needed to save a run.
+
+        Parameters
+        ----------
+        step, log_binning
+          The detector binning, as for :py:meth:`time_channels`
+        seconds : float
+          The length of the run
+        periods : int
+          The number of DAE periods in the run
+
+        Returns
+        -------
+        float
+          The estimated time in seconds to write the run to disk.
+
+        """
+        histogram = 4.0 * self.detector_spectra * periods * \
+            self.time_channels(step, log_binning)
+        return (histogram + self.event_bytes_rate * seconds) / self.save_rate
+
+    def choose_binning(self, seconds, finest=None, coarsest=None,
+                       periods=1):
+        """Pick the event mode binning for a run of a given length.
+
+        The finest linear binning is chosen which will still save
+        within ``save_limit`` seconds.  If even the coarsest binning
+        allowed is too slow, the log binning of event_fastsave is
+        used instead.  Nothing on the instrument is changed.
+
+        Parameters
+        ----------
+        seconds : float
+          The planned length of the run
+        finest, coarsest : float
+          The bounds, in microseconds, on the TOF step.  These default
+          to ``tof_step_finest`` and ``tof_step_coarsest``.
+        periods : int
+          The number of DAE periods in the run
+
+        Returns
+        -------
+        tuple
+          The name of the chosen DAE mode and its TOF step
+
+        """
+        if finest is None:
+            finest = self.tof_step_finest
+        if coarsest is None:
+            coarsest = self.tof_step_coarsest
+        budget = self.save_limit - \
+            self.event_bytes_rate * seconds / self.save_rate
+        channels = budget * self.save_rate / \
+            (4.0 * self.detector_spectra * periods)
+        step = finest
+        if channels > 0:
+            step = max(finest,
+                       float(ceil((self.tof_range[1] - self.tof_range[0]) /
+                                  channels)))
+        if channels > 0 and step <= coarsest:
+            mode = "event"
+            info("Binning events in {:g}us steps, saving in about "
+                 "{:.0f}s".format(step, self.save_time(
+                     step, seconds=seconds, periods=periods)))
+        else:
+            mode = "event_fastsave"
+            step = self.fastsave_step
+            estimate = self.save_time(self.fastsave_step, True,
+                                      seconds=seconds, periods=periods)
+            info("Using log binning, saving in about {:.0f}s".format(
+                estimate))
+            if estimate > self.save_limit:
+                warning("The run will still take {:.0f}s to save".format(
+                    estimate))
+        return mode, step
+
+    def measure(self, title, pos=None, thickness=1.0, trans=False,
+                dae=None, blank=False, aperature="", bench=None, **kwargs):
+        """Take a sample measurement.
+
+        This accepts all of the parameters of
+        :py:meth:`src.Instrument.ScanningInstrument.measure`, plus
+
+        Parameters
+        ----------
+        bench : float or None
+          The angle of the downstream arm for the measurement.  If the
+          bench is at a different angle, it is moved with
+          :py:meth:`movebench` before the measurement.  If None, the
+          bench is left where it is.
+        dae : str
+          As well as the usual modes, "auto" picks the event mode
+          binning for the length of the run with
+          :py:meth:`choose_binning`.  The binning is only used for
+          this measurement and the default DAE mode is unchanged.
+
+        """
+        if bench is not None and \
+           abs(bench - block_value("bench_rot")) > self.bench_tolerance:
+            self.movebench(bench)
+        if dae == "auto" and not trans:
+            planned = [SCALES[k] * kwargs[k] for k in SCALES if k in kwargs]
+            mode, step = self.choose_binning(sum(planned))
+            default, previous = self.setup_sans, self.step
+            if mode == "event" and step != previous:
+                self.set_tof_step(step)
+            try:
+                self.setup_sans = getattr(self, "setup_dae_" + mode)
+                ScanningInstrument.measure(
+                    self, title, pos=pos, thickness=thickness, trans=trans,
+                    blank=blank, aperature=aperature, **kwargs)
+            finally:
+                self.setup_sans = default
+                if self.step != previous:
+                    self.set_tof_step(previous)
+            return
+        if dae == "auto":
+            dae = None
+        ScanningInstrument.measure(
+            self, title, pos=pos, thickness=thickness, trans=trans,
+            dae=dae, blank=blank, aperature=aperature, **kwargs)
+
+    def _order_plan(self, rows):
+        rows, saved, travel = bench_order(
+            rows, start=block_value("bench_rot"))
+        if saved:
+            info("Grouping by bench angle saves {} detector power cycles "
+                 "and {:g} degrees of rotation (up to {:.0f} minutes)".format(
+                     saved, travel, saved * self.bench_cycle_time / 60.0))
+        return rows
+
     @staticmethod
     def _generic_scan(  # pylint: disable=dangerous-default-value
             detector=r"C:\Instrument\Settings\Tables\detector.dat",
@@ -72,26 +355,67 @@ class Larmor(ScanningInstrument):  # pylint: disable=too-many-public-methods
             tcbs=[]):
         ScanningInstrument._generic_scan(detector, spectra, wiring, tcbs)
 
+    @staticmethod
+    def chopper_phases(lrange):
+        """Find the chopper phases for a wavelength range.
+
+        Parameters
+        ----------
+        lrange : str
+          The wavelength range, e.g. "0.9-13.25"
+
+        Returns
+        -------
+        dict
+          The phase for each chopper block
+
+        Ranges which are not in ``CHOPPER_PHASES`` are interpolated
+        from the neighbouring ranges by their minimum wavelength.
+
+        """
+        if lrange in Larmor.CHOPPER_PHASES:
+            return dict(Larmor.CHOPPER_PHASES[lrange])
+        known = sorted(Larmor.CHOPPER_PHASES,
+                       key=lambda x: float(x.split("-")[0]))
+        try:
+            lmin = float(lrange.split("-")[0])
+        except ValueError:
+            lmin = None
+        for low, high in zip(known, known[1:]):
+            low_min = float(low.split("-")[0])
+            high_min = float(high.split("-")[0])
+            if lmin is None or not low_min <= lmin <= high_min:
+                continue
+            frac = (lmin - low_min) / (high_min - low_min)
+            below = Larmor.CHOPPER_PHASES[low]
+            above = Larmor.CHOPPER_PHASES[high]
+            return {k: below[k] + frac * (above[k] - below[k])
+                    for k in below if k in above}
+        raise RuntimeError(
+            "The lrange {} is outside of the known lranges for the "
+            "chopper: {}".format(lrange, ", ".join(known)))
+
+    @staticmethod
+    def _choppers_in_phase(phases):
+        """Have the choppers reached the requested phases?"""
+        current = snapshot(sorted(phases))
+        return all([abs(current[k] - phases[k]) <=
+                    Larmor.chopper_tolerance for k in sorted(phases)])
+
     @staticmethod
     def _set_choppers(lrange):
-        # now set the chopper phasing to the defaults
-        # T0 phase checked for November 2015 cycle
-        # Running at 5Hz and centering the dip from the T0 at 50ms by
-        # setting phase to 48.4ms does not stop the fast flash
-        # Setting the T0 phase to 0 (50ms) does
-        if lrange == "0.9-13.25":
-            # This is for 0.9-13.25
-            gen.cset(T0Phase=0)
-            gen.cset(TargetDiskPhase=2750)
-            gen.cset(InstrumentDiskPhase=2450)
-        elif lrange == "0.65-12.95":
-            # This is for 0.65-12.95
-            gen.cset(TargetDiskPhase=1900)
-            gen.cset(InstrumentDiskPhase=1600)
-        else:
-            raise RuntimeError(
-                "The only known lranges for the chopper "
-                "are '0.9-13.25' and '0.65-12.95'")
+        phases = Larmor.chopper_phases(lrange)
+        current = snapshot(sorted(phases))
+        changed = [k for k in sorted(phases)
+                   if abs(current[k] - phases[k]) >
+                   Larmor.chopper_tolerance]
+        if not changed:
+            return
+        for block in changed:
+            gen.cset(block, phases[block])
+        if not wait_until(lambda: Larmor._choppers_in_phase(phases),
+                          timeout=Larmor.chopper_settle_time):
+            warning("The choppers did not reach the requested phases")
 
     @dae_setter("SCAN", "scan")
     def setup_dae_scanning(self):
@@ -138,8 +462,8 @@ class Larmor(ScanningInstrument):  # pylint: disable=too-many-public-methods
             wiring=r"C:\Instrument\Settings\Tables\wiring_event_fastsave.dat",
             # change to log binning to reduce number of detector bins
             # by a factor of 10 to decrease write time
-            tcbs=[{"low": 5.0, "high": 100000.0, "step": 0.1,
-                   "trange": 1, "log": 1},
+            tcbs=[{"low": 5.0, "high": 100000.0,
+                   "step": self.fastsave_step, "trange": 1, "log": 1},
                   {"low": 0.0, "high": 0.0, "step": 0.0,
                    "trange": 2, "log": 0},
                   {"low": 5.0, "high": 100000.0, "step": 2.0, "trange": 1,
@@ -219,15 +543,125 @@ class Larmor(ScanningInstrument):  # pylint: disable=too-many-public-methods
                   {"low": 0.0, "high": 0.0, "step": 0.0,
                    "trange": 2, "log": 0}])
 
-    @staticmethod
     @dae_setter("SANS", "sans")
-    def setup_dae_polarised():
+    def setup_dae_polarised(self):
         """Set the wiring tables for a polarisation measurement."""
         Larmor._generic_scan(
             tcbs=[{"low": 5.0, "high": 100000.0, "step": 100.0, "trange": 1},
                   {"low": 0.0, "high": 0.0, "step": 0.0,
                    "trange": 2, "log": 0}])
 
+    def set_spin_states(self, states):
+        """Choose the spin states of a polarised run.
+
+        Parameters
+        ----------
+        states : list of dict
+          Every state needs a ``label``.  The ``flipper1`` key gives
+          the state of the polariser flipper and any other key is a
+          block to set, such as an analyser flipper.
+
+        Examples
+        --------
+
+        >>> set_spin_states([
+        ...     {"label": "++", "flipper1": 1, "Analyser": 1},
+        ...     {"label": "+-", "flipper1": 1, "Analyser": 0},
+        ...     {"label": "-+", "flipper1": 0, "Analyser": 1},
+        ...     {"label": "--", "flipper1": 0, "Analyser": 0}])
+
+        """
+        labels = [state.get("label") for state in states]
+        if not states or None in labels:
+            raise ValueError("Every spin state needs a label")
+        if len(set(labels)) != len(labels):
+            raise ValueError("The spin states need different labels")
+        if any("," in label for label in labels):
+            raise ValueError("Spin state labels cannot contain commas")
+        self._check_journal("id", self._spin_id(states))
+        self.spin_states = [dict(state) for state in states]
+        info("Spin states: " + ", ".join(labels))
+
+    @staticmethod
+    def _spin_id(states):
+        """The journal id which lists the spin state of each period."""
+        return "spin:" + ",".join([state["label"] for state in states])
+
+    def _begin_polarised(self):
+        """Start a paused run with a period for every spin state.
+
+        The measurement id lists the spin states until the run ends."""
+        spin_id = self._spin_id(self.spin_states)
+        self._check_journal("id", spin_id)
+        previous = self._measurement_id
+        self.set_measurement_id(spin_id)
+        self._spin_previous_id = previous
+        gen.change(nperiods=len(self.spin_states))
+        gen.begin(paused=1)
+
+    def _end_polarised(self):
+        """End a polarised run and restore the previous measurement id."""
+        gen.end()
+        self.set_measurement_id(self._spin_previous_id)
+
+    @staticmethod
+    def _set_spin_state(state):
+        """Put the flippers into a spin state."""
+        blocks = {k: v for k, v in state.items()
+                  if k not in ("label", "flipper1")}
+        if "flipper1" in state:
+            gen.flipper1(state["flipper1"])
+        if blocks:
+            gen.cset(**blocks)
+            gen.waitfor_move()
+
+    def _waitfor_polarised(self, ratio=None, **kwargs):
+        """Cycle through the spin states in a single run
+
+        Every state is counted in its own period, pausing the run
+        while the flippers change, in the same way as
+        :py:meth:`_waitfor_sesans`.  The ``ratio`` gives the share of
+        each cycle for every state.  If it is "auto", the first cycle
+        measures the count rate of each state, which then sets the
+        split for the rest of the run."""
+        if ratio is None:
+            ratio = self.spin_ratio
+        adaptive = ratio == "auto"
+        if adaptive or ratio is None:
+            ratio = [1] * len(self.spin_states)
+        if len(ratio) != len(self.spin_states):
+            raise ValueError("Need a ratio for each of the {} spin "
+                             "states".format(len(self.spin_states)))
+        total = float(sum(ratio))
+        self.flipper_cycle = PeriodCycle(
+            [Step(period, max(1, int(round(self.spin_cycle * share / total))),
+                  "Spin state " + state["label"],
+                  partial(self._set_spin_state, state))
+             for period, (state, share) in enumerate(
+                 zip(self.spin_states, ratio), 1)])
+        if adaptive:
+            self._split_polarised()
+        if "uamps" in kwargs:
+            self.flipper_cycle.run(uamps=kwargs["uamps"])
+        elif "frames" in kwargs:
+            self.flipper_cycle.run(frames=kwargs["frames"])
+        else:
+            raise ValueError("Polarised runs are counted in uamps or frames")
+
+    def _split_polarised(self):
+        """Balance the frames in each spin state from a trial cycle."""
+        cycle = self.flipper_cycle
+        cycle.run(cycles=1)
+        rates = [float(gen.integrate_spectrum(self.spin_spectrum,
+                                              period=step.period)) /
+                 step.frames for step in cycle.steps]
+        for step, count in zip(cycle.steps,
+                               split_frames(rates, self.spin_cycle)):
+            step.frames = count
+        info("Balanced spin states " + " ".join(
+            ["{}={}".format(state["label"], step.frames)
+             for state, step in zip(self.spin_states, cycle.steps)]))
+
     @dae_setter("SANS", "sans")
     def setup_dae_bsalignment(self):
         Larmor._generic_scan(
@@ -292,37 +726,130 @@ class Larmor(ScanningInstrument):  # pylint: disable=too-many-public-methods
         gen.change(nperiods=2)
         gen.begin(paused=1)
 
-    @staticmethod
-    def _waitfor_sesans(u=1000, d=1000,
+    def _waitfor_sesans(self, u=1000, d=1000,
                         **kwargs):  # pylint: disable=invalid-name
-        """Perform a SESANS run"""
+        """Perform a SESANS run
+
+        If either ``u`` or ``d`` is "auto", the first cycle measures
+        the count rates and the flipping overhead, which then set the
+        frames in each state for the rest of the run.
+
+        The cycle of flipper states is kept in ``flipper_cycle``,
+        whose :py:meth:`src.flipper.PeriodCycle.summary` gives the
+        beam lost to flipping."""
+        adaptive = "auto" in (u, d)
+        if adaptive:
+            u, d = 1000, 1000
+        self.flipper_cycle = PeriodCycle(
+            [Step(1, u, "Flipper On", lambda: gen.flipper1(1)),
+             Step(2, d, "Flipper Off", lambda: gen.flipper1(0))])
+        if adaptive:
+            self._split_sesans()
         if "uamps" in kwargs:
-            get_total = gen.get_uamps
-            key = "uamps"
+            self.flipper_cycle.run(uamps=kwargs["uamps"])
         else:
-            get_total = gen.get_frames
-            key = "frames"
-        gfrm = gen.get_frames()
-        gtotal = get_total()
-
-        while gtotal < kwargs[key]:
-            gen.change(period=1)
-            info("Flipper On")
-            gen.flipper1(1)
-            gfrm = gen.get_frames()
-            gen.resume()
-            gen.waitfor(frames=gfrm+u)
-            gen.pause()
-
-            gen.change(period=2)
-            info("Flipper Off")
-            gen.flipper1(1)
-            gfrm = gen.get_frames()
-            gen.resume()
-            gen.waitfor(frames=gfrm+d)
-            gen.pause()
-
-            gtotal = get_total()
+            self.flipper_cycle.run(frames=kwargs["frames"])
+
+    def _split_sesans(self):
+        """Choose the frames in each flipper state from a trial cycle."""
+        cycle = self.flipper_cycle
+        cycle.run(cycles=1)
+        rates = [float(gen.integrate_spectrum(self.sesans_spectrum,
+                                              period=step.period)) /
+                 step.frames for step in cycle.steps]
+        lost = cycle.cycles[-1]["lost"]
+        frames = lost * (1 - self.sesans_overhead) / self.sesans_overhead
+        frames = min(max(frames, self.sesans_shortest * self.frame_rate),
+                     self.sesans_longest * self.frame_rate)
+        for step, count in zip(cycle.steps, split_frames(rates, frames)):
+            step.frames = count
+        info("Adaptive SESANS split u={} d={}".format(
+            *[step.frames for step in cycle.steps]))
+
+    def set_echo_tune(self, echo, sel, **blocks):
+        """Set the spin echo tune for the following measurements.
+
+        Parameters
+        ----------
+        echo : int
+          The id of the echo scan which found the tune
+        sel : float
+          The spin echo length of the tune
+        **blocks
+          The blocks to move to put the instrument into the tune
+
+        """
+        info("Tuning to echo {} (SEL {})".format(echo, sel))
+        self.set_measurement_id("{},{}".format(echo, sel))
+        if blocks:
+            gen.cset(**blocks)
+            gen.waitfor_move()
+
+    def echo_scan(self, tunes, samples, **kwargs):
+        """Measure a set of samples at a series of spin echo tunes.
+
+        Every sample is measured at one tune before the fields are
+        ramped to the next, and the tunes are visited in the order
+        that needs the least ramping.  The measurement id of each run
+        records its echo id and spin echo length, ready for
+        :py:func:`src.reduction.sesans_connection`.  The previous
+        measurement id is restored once the scan is over.
+
+        The scan is run through the simulator to check for errors
+        before attempting a real run.
+
+        Parameters
+        ----------
+        tunes : list of dict
+          Each tune gives its ``echo`` id and ``sel`` spin echo length.
+          Any other keys are blocks which are set to reach the tune.
+        samples : list of dict
+          The parameters to :py:meth:`measure` for each sample.
+        **kwargs
+          Parameters to :py:meth:`measure` shared by every sample,
+          such as the length of the run.  The DAE defaults to
+          SESANS mode.
+
+        Examples
+        --------
+
+        >>> echo_scan([{"echo": 1120, "sel": 50.0, "Coil1": 10},
+        ...            {"echo": 1121, "sel": 75.0, "Coil1": 15}],
+        ...           [{"title": "H2O", "pos": "AT"},
+        ...            {"title": "D2O", "pos": "BT"}],
+        ...           frames=6000)
+
+        """
+        from .Util import user_script
+
+        # The order is chosen once, from the real fields, so that the
+        # check and the real run visit the tunes in the same order.
+        blocks = sorted(set([block for tune in tunes for block in tune
+                             if block not in ("echo", "sel")]))
+        start = snapshot(blocks)
+        ordered = tune_order(tunes, start, self.ramp_rates)
+        info("Ordering the tunes ramps the fields for {:.0f}s "
+             "instead of {:.0f}s".format(
+                 ramp_time(ordered, start, self.ramp_rates),
+                 ramp_time(tunes, start, self.ramp_rates)))
+
+        @user_script
+        def inner():
+            """Tune the instrument and measure the samples"""
+            previous = self._measurement_id
+            try:
+                for tune in ordered:
+                    tune = dict(tune)
+                    self.set_echo_tune(tune.pop("echo"), tune.pop("sel"),
+                                       **tune)
+                    for sample in samples:
+                        params = {"dae": "sesans"}
+                        params.update(kwargs)
+                        params.update(sample)
+                        self.measure(**params)
+            finally:
+                self.set_measurement_id(previous)
+        inner()
 
     @staticmethod
     def set_aperature(size):
@@ -337,14 +864,17 @@ class Larmor(ScanningInstrument):  # pylint: disable=too-many-public-methods
         # move the transmission monitor in
         gen.cset(m4trans=0.0)
 
+    @staticmethod
+    def _detector_status():
+        """The status of each detector high voltage channel."""
+        return [
+            gen.get_pv("IN:LARMOR:CAEN:hv0:0:{}:status".format(x)).lower()
+            for x in [8, 9, 10, 11]]
+
     @staticmethod
     def _detector_is_on():
         """Is the detector currently on?"""
-        voltage_status = all([
-            gen.get_pv(
-                "IN:LARMOR:CAEN:hv0:0:{}:status".format(x)).lower() == "on"
-            for x in [8, 9, 10, 11]])
-        return voltage_status
+        return all([x == "on" for x in Larmor._detector_status()])
 
     @staticmethod
     def _detector_turn_on(delay=True):
@@ -353,8 +883,11 @@ class Larmor(ScanningInstrument):  # pylint: disable=too-many-public-methods
         gen.set_pv("IN:LARMOR:CAEN:hv0:0:10:pwonoff", "On")
         gen.set_pv("IN:LARMOR:CAEN:hv0:0:11:pwonoff", "On")
         if delay:
-            info("Waiting For Detector To Power Up (180s)")
-            sleep(180)
+            info("Waiting For Detector To Power Up (up to {}s)".format(
+                Larmor.detector_power_up))
+            if not wait_until(Larmor._detector_is_on, poll=5,
+                              timeout=Larmor.detector_power_up):
+                warning("The detector did not report that it was on")
 
     @staticmethod
     def _detector_turn_off(delay=True):
@@ -363,8 +896,13 @@ class Larmor(ScanningInstrument):  # pylint: disable=too-many-public-methods
         gen.set_pv("IN:LARMOR:CAEN:hv0:0:10:pwonoff", "Off")
         gen.set_pv("IN:LARMOR:CAEN:hv0:0:11:pwonoff", "Off")
         if delay:
-            info("Waiting For Detector To Power Down (60s)")
-            sleep(60)
+            info("Waiting For Detector To Power Down (up to {}s)".format(
+                Larmor.detector_power_down))
+            if not wait_until(
+                    lambda: all([x == "off"
+                                 for x in Larmor._detector_status()]),
+                    poll=5, timeout=Larmor.detector_power_down):
+                warning("The detector did not report that it was off")
 
     # Instrument Specific Scripts
     @staticmethod
@@ -388,8 +926,7 @@ class Larmor(ScanningInstrument):  # pylint: disable=too-many-public-methods
         # Convert to angle instead of mm
         gen.cset(pol_trans=100, pol_arc=-0.069)
 
-    @staticmethod
-    def BSInOut(In=True):  # pylint: disable=invalid-name
+    def BSInOut(self, In=True):  # pylint: disable=invalid-name
         """Move the Beam Stop in and out of the beam.
 
         Parameters
@@ -399,24 +936,64 @@ class Larmor(ScanningInstrument):  # pylint: disable=too-many-public-methods
         """
         # move beamstop in or out. The default is to move in
         if In:
-            gen.cset(BSY=88.5, BSZ=353.0)
+            gen.cset(**self.beamstop_in)
         else:
-            gen.cset(BSY=200.0, BSZ=0.0)
+            gen.cset(**self.beamstop_out)
 
-    @staticmethod
-    def _generic_home_slit(slit):
-        # home north and west
-        gen.set_pv(slit + "JN: MTR.HOMR", "1")
-        gen.set_pv(slit + "JW: MTR.HOMR", "1")
+    def align_beamstop(self, width=20.0, tolerance=0.2, **kwargs):
+        """Centre the beam stop on the direct beam.
+
+        Each axis of the beam stop is scanned in turn with
+        :py:meth:`find_centre`, looking for the dip in the transmitted
+        counts.  The centre becomes the new position for
+        :py:meth:`BSInOut` and the beam stop is left there.
+
+        Parameters
+        ----------
+        width : float
+          The range of the first scan of each axis, in mm
+        tolerance : float
+          The precision of the final position, in mm
+        **kwargs
+          The time to count at each point.  The default is 50 frames.
+
+        Returns
+        -------
+        dict
+          The aligned position of each axis
+
+        """
+        if not self.sanitised_timings(kwargs):
+            kwargs["frames"] = 50
+        found = dict(self.beamstop_in)
+        gen.cset(**found)
         gen.waitfor_move()
-        gen.set_pv(slit + "JN: MTR.VAL", "20")
-        gen.set_pv(slit + "JW: MTR.VAL", "20")
-        # home south and east
-        gen.set_pv(slit + "JS: MTR.HOMR", "1")
-        gen.set_pv(slit + "JE: MTR.HOMR", "1")
+        for block in sorted(found):
+            others = dict([(key, value) for key, value in found.items()
+                           if key != block])
+            others.update(kwargs)
+            found[block] = self.find_centre(
+                "Beamstop alignment", block, found[block], width,
+                tolerance, dip=True, dae="bsalignment", **others)
+        info("Beamstop centred at " + ", ".join(
+            ["{}={:.2f}".format(key, found[key]) for key in sorted(found)]))
+        self.beamstop_in = found
+        self.BSInOut(True)
         gen.waitfor_move()
-        gen.set_pv(slit + "JS: MTR.VAL", "20")
-        gen.set_pv(slit + "JE: MTR.VAL", "20")
+        return found
+
+    @staticmethod
+    def _generic_home_slit(*slits):
+        # Every jaw set is an independent axis, so each phase of the
+        # homing is sent to all of the slits before waiting
+        for pair in [["JN", "JW"], ["JS", "JE"]]:
+            for slit in slits:
+                for jaw in pair:
+                    gen.set_pv(slit + jaw + ": MTR.HOMR", "1")
+            gen.waitfor_move()
+            for slit in slits:
+                for jaw in pair:
+                    gen.set_pv(slit + jaw + ": MTR.VAL", "20")
         gen.waitfor_move()
 
     @staticmethod
@@ -443,6 +1020,17 @@ class Larmor(ScanningInstrument):  # pylint: disable=too-many-public-methods
         gen.waitfor_move()
         Larmor._generic_home_slit("IN: LARMOR: MOT: JAWS3: ")
 
+    @staticmethod
+    def home_all_slits():
+        """Rehome the coarse jaws, aperature 1, and slit 1 together."""
+        info("Homing Coarse Jaws, a1, and s1")
+        gen.cset(cjhgap=40, cjvgap=40, a1hgap=40, a1vgap=40,
+                 s1hgap=40, s1vgap=40)
+        gen.waitfor_move()
+        Larmor._generic_home_slit("IN: LARMOR: MOT: JAWS1: ",
+                                  "IN: LARMOR: MOT: JAWS2: ",
+                                  "IN: LARMOR: MOT: JAWS3: ")
+
     @staticmethod
     def homes2():
         """Rehome slit2.  This is currentl a no-op."""
@@ -457,6 +1045,12 @@ class Larmor(ScanningInstrument):  # pylint: disable=too-many-public-methods
         info("Turning Detector Back on")
         self.detector_on(True, delay=delaydet)
 
+    @property
+    def bench_cycle_time(self):
+        """The longest dead time, in seconds, for each bench move."""
+        return self.detector_power_down + self.detector_power_up + \
+            2 * self.bench_lift_time
+
     def rotatebench(self, angle=0.0):
         """Move the downstream arm"""
         if self.detector_on():
@@ -468,20 +1062,26 @@ class Larmor(ScanningInstrument):  # pylint: disable=too-many-public-methods
 
         if angle >= -0.5:
             gen.cset(benchlift=1)
-            info("Lifting Bench (20s)")
-            sleep(20)
-
-            if gen.get_pv("IN: LARMOR: BENCH: STATUS") == 1:
+            info("Lifting Bench (up to {}s)".format(self.bench_lift_time))
+            if wait_until(lambda: self._bench_status() == 1,
+                          timeout=self.bench_lift_time):
                 info("Rotating Bench")
                 gen.cset(bench_rot=angle)
                 gen.waitfor_move()
-                info("Lowering Bench (20s)")
+                info("Lowering Bench (up to {}s)".format(
+                    self.bench_lift_time))
                 gen.cset(benchlift=0)
-                sleep(20)
+                wait_until(lambda: self._bench_status() == 0,
+                           timeout=self.bench_lift_time)
             else:
                 info("Bench failed to lift")
                 info("Move not attempted")
 
+    @staticmethod
+    def _bench_status():
+        """Whether the bench is lifted (1) or lowered (0)"""
+        return gen.get_pv("IN: LARMOR: BENCH: STATUS")
+
     @staticmethod
     def setup_pi_rotation():
         """Initialise the pi flipper."""
@@ -489,7 +1089,7 @@ class Larmor(ScanningInstrument):  # pylint: disable=too-many-public-methods
                   "VEL 1 180", "ACC 1 90", "DEC 1 90"]
         gen.set_pv("IN: LARMOR: SDTEST_01: P2: COMM", script[0])
         for line in script[1:]:
-            sleep(1)
+            gen.waitfor(seconds=Larmor.pi_command_time)
             gen.set_pv("IN: LARMOR: SDTEST_01: P2: COMM", line)
 
     @staticmethod
@@ -1,8 +1,11 @@
 """Useful utilities for scriping"""
 from functools import wraps
 import logging
-from logging import info
-from .genie import SwitchGenie
+from logging import info, warning
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from time import time
+from .genie import SwitchGenie, gen
 
 
 def dae_setter(suffix, measurement_type):
@@ -56,6 +59,152 @@ def dae_setter(suffix, measurement_type):
     return decorator
 
 
+def block_value(block):
+    """Read the current value of a block.
+
+    genie_python returns a dictionary describing the block, while the
+    mock genie returns the bare value.  This function always gives
+    the value.
+
+    Parameters
+    ----------
+    block : str
+      The name of the block
+
+    """
+    result = gen.cget(block)
+    if isinstance(result, dict):
+        return result["value"]
+    return result
+
+
+def _read(request):
+    """Read a single block or PV for a snapshot."""
+    target, kind, name = request
+    with SwitchGenie.pinned(target):
+        if kind == "block":
+            return block_value(name)
+        return gen.get_pv(name)
+
+
+# The threads which read snapshots when genie cannot read several
+# values in one request.  The pool is shared by every snapshot and
+# only started when it is first needed.
+SNAPSHOT_THREADS = 8
+_SNAPSHOT_POOL = []
+_SNAPSHOT_LOCK = Lock()
+
+
+def _snapshot_pool():
+    """The shared pool of threads for reading snapshots."""
+    with _SNAPSHOT_LOCK:
+        if not _SNAPSHOT_POOL:
+            _SNAPSHOT_POOL.append(ThreadPool(SNAPSHOT_THREADS))
+        return _SNAPSHOT_POOL[0]
+
+
+def snapshot(blocks=None, pvs=()):
+    """Read many blocks and PVs at once.
+
+    If genie can read several values in one request, a single request
+    is made.  Otherwise, the values are read in parallel on a shared
+    pool of threads, so that the round trips to the instrument
+    overlap.  Two values or fewer are simply read in turn.
+
+    Parameters
+    ----------
+    blocks : list of str
+      The blocks to read.  If None, every block on the instrument is
+      read.
+    pvs : list of str
+      The PVs to read
+
+    Returns
+    -------
+    dict
+      The value of every block and PV, by name
+
+    """
+    blocks = sorted(gen.get_blocks()) if blocks is None else list(blocks)
+    pvs = list(pvs)
+    if not blocks and not pvs:
+        return {}
+    target = SwitchGenie.target()
+    batch = getattr(target, "snapshot", None)
+    if batch is not None:
+        return dict(batch(blocks, pvs))
+    requests = [(target, "block", b) for b in blocks] + \
+        [(target, "pv", p) for p in pvs]
+    if len(requests) <= 2:
+        values = [_read(request) for request in requests]
+    else:
+        values = _snapshot_pool().map(_read, requests)
+    return dict(zip(blocks + pvs, values))
+
+
+def instrument_time():
+    """The current time on the instrument, in seconds.
+
+    A simulated instrument keeps its own clock, which may run faster
+    than real time, and the mock instrument's clock only moves when it
+    is told to wait.  Every other backend follows the computer's clock.
+
+    """
+    from .genie import mock_gen
+    target = SwitchGenie.target()
+    if target is mock_gen:
+        return mock_gen.mock_clock
+    if hasattr(type(target), "clock"):
+        return target.clock()
+    return time()
+
+
+def wait_until(test, poll=1.0, timeout=None):
+    """Wait until a condition is met or a time limit is reached.
+
+    Parameters
+    ----------
+    test : function
+      Takes no arguments and returns True once the condition is met.
+    poll : float
+      The time, in seconds, between checks of the condition.
+    timeout : float or None
+      The longest time, in seconds, to wait for the condition.  If
+      None, wait for as long as it takes.
+
+    Returns
+    -------
+    bool
+      Whether the condition was met.
+
+    The waiting is performed through genie, so that simulated runs
+    account for the time spent.  If the condition cannot be checked at
+    all (e.g. the status PV is missing), the full timeout is waited,
+    which matches the old fixed delays.
+
+    """
+    waited = 0.0
+    while True:
+        try:
+            if test():
+                return True
+        except Exception:  # pylint: disable=broad-except
+            if timeout is None:
+                raise
+            warning("Cannot check condition, waiting {}s".format(
+                timeout - waited))
+            gen.waitfor(seconds=timeout - waited)
+            return False
+        if timeout is None:
+            step = poll
+        elif waited >= timeout:
+            return False
+        else:
+            step = min(poll, timeout - waited)
+        gen.waitfor(seconds=step)
+        waited += step
+
+
 SCALES = {"uamps": 90, "frames": 0.1, "seconds": 1,
           "minutes": 60, "hours": 3600}
 
@@ -100,32 +249,43 @@ def pretty_print_time(seconds):
     return skeleton.format(hours, delta+datetime.now())
 
 
+def dry_run(script, *args, **kwargs):
+    """Run a script against the mock instrument.
+
+    Parameters
+    ----------
+    script : function
+      The script to check
+    *args, **kwargs
+      The arguments to the script
+
+    Returns
+    -------
+    float
+      The approximate time, in seconds, that the script will take.
+      Any error in the script is raised.
+
+    """
+    from .genie import mock_gen
+    gen.cache_clear()
+    mock_gen.reset_mock()
+    logging.getLogger().disabled = True
+    old = SwitchGenie.MOCKING_MODE
+    try:
+        SwitchGenie.MOCKING_MODE = True
+        script(*args, **kwargs)
+    finally:
+        SwitchGenie.MOCKING_MODE = old
+        logging.getLogger().disabled = False
+    return sum([wait_time(call) for call in mock_gen.mock_calls])
+
+
 def user_script(script):
     """A decorator to perform some sanity checking on a user script before
     it is run"""
     @wraps(script)
     def inner(*args, **kwargs):
         """Mock run a script before running it for real."""
-        from mock import Mock
-        from .genie import mock_gen
-        code = script.__name__ + "("
-        code += ", ".join(map(str, args))
-        for k in kwargs:
-            code += ", " + k + "=" + str(kwargs[k])
-        code += ")"
-        mock_gen.reset_mock()
-        logging.getLogger().disabled = True
-        try:
-            old = SwitchGenie.MOCKING_MODE
-            SwitchGenie.MOCKING_MODE = True
-            eval(code,  # pylint: disable=eval-used
-                 {"MOCKING_MODE": True, "logging": Mock()},
-                 {script.__name__: script})
-            SwitchGenie.MOCKING_MODE = old
-        finally:
-            logging.getLogger().disabled = False
-        calls = mock_gen.mock_calls
-        time = sum([wait_time(call) for call in calls])
-        logging.info(pretty_print_time(time))
+        logging.info(pretty_print_time(dry_run(script, *args, **kwargs)))
         script(*args, **kwargs)
     return inner
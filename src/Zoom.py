@@ -21,13 +21,17 @@ class Zoom(ScanningInstrument):
                 '8WT', '9WT', '10WT', '11WT', '12WT', '13WT', '14WT']
 
     def set_measurement_type(self, value):
+        value = self._fit_journal("type", value)
         gen.set_pv("IN:ZOOM:PARS:SAMPLE:MEAS:TYPE", value)
 
     def set_measurement_label(self, value):
+        value = self._fit_journal("label", value)
         gen.set_pv("IN:ZOOM:PARS:SAMPLE:MEAS:LABEL", value)
 
     def set_measurement_id(self, value):
+        value = self._fit_journal("id", value)
         gen.set_pv("IN:ZOOM:PARS:SAMPLE:MEAS:ID", value)
+        self._measurement_id = value
 
     @dae_setter("SCAN", "scan")
     def setup_dae_scanning(self):
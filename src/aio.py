@@ -0,0 +1,178 @@
+"""Concurrent access to the instrument for expert scripts.
+
+Every genie command blocks until the instrument has finished, so a
+normal script can only do one thing at a time.  The
+:py:class:`AsyncInstrument` class wraps a
+:py:class:`src.Instrument.ScanningInstrument` and starts each
+blocking command on a pool of threads.  Every command returns a task
+at once, so that independent hardware operations proceed together,
+and :py:func:`gather` waits for a group of tasks to finish.
+
+Each task stays on the genie (real, mock, or simulated) which was in
+use when it was started, even if a dry run begins in the meantime.
+
+Normal user scripts are unaffected and continue to run synchronously.
+
+"""
+from multiprocessing.pool import ThreadPool
+from .genie import SwitchGenie, gen
+from .Util import wait_until
+
+
+def _pinned_call(target, function, args, kwargs):
+    """Run a function with every genie call sent to one target."""
+    with SwitchGenie.pinned(target):
+        return function(*args, **kwargs)
+
+
+def gather(*tasks):
+    """Wait for several tasks to finish.
+
+    Parameters
+    ----------
+    *tasks : multiprocessing.pool.AsyncResult
+      The tasks returned by the :py:class:`AsyncInstrument` commands
+
+    Returns
+    -------
+    list
+      The result of each task, in order.  If any task failed, its
+      exception is raised once every task has finished.
+
+    """
+    for task in tasks:
+        task.wait()
+    return [task.get() for task in tasks]
+
+
+class AsyncInstrument(object):
+    """Concurrent versions of the instrument commands.
+
+    Parameters
+    ----------
+    instrument : ScanningInstrument
+      The instrument which performs the commands
+    threads : int
+      The most commands which may run at the same time
+
+    Every command returns a
+    :py:class:`multiprocessing.pool.AsyncResult`.  Call ``get()`` on
+    it, or pass it to :py:func:`gather`, to wait for the result.
+
+    Any public method of the instrument which does not have an explicit
+    wrapper below can still be started through this object.  For
+    example, ``inst.movebench(5)`` runs ``movebench`` in the
+    background.
+
+    """
+
+    def __init__(self, instrument, threads=8):
+        self.instrument = instrument
+        self.pool = ThreadPool(threads)
+
+    def run(self, function, *args, **kwargs):
+        """Start a blocking function in the background.
+
+        Parameters
+        ----------
+        function : function
+          The blocking call to perform
+        *args
+          The positional arguments for the function
+        **kwargs
+          The keyword arguments for the function
+
+        Returns
+        -------
+        multiprocessing.pool.AsyncResult
+          The running task
+
+        """
+        return self.pool.apply_async(
+            _pinned_call, (SwitchGenie.target(), function, args, kwargs))
+
+    def close(self):
+        """Wait for every task to finish and stop the threads."""
+        self.pool.close()
+        self.pool.join()
+
+    def __getattr__(self, name):
+        method = getattr(self.instrument, name)
+        if name.startswith("_") or not callable(method):
+            return method
+
+        def inner(*args, **kwargs):
+            """Start the instrument method."""
+            return self.run(method, *args, **kwargs)
+        inner.__name__ = name
+        inner.__doc__ = method.__doc__
+        return inner
+
+    @staticmethod
+    def _move(args, kwargs, wait):
+        gen.cset(*args, **kwargs)
+        if wait:
+            gen.waitfor_move(*(list(args[:1]) + list(kwargs)))
+
+    def cset(self, *args, **kwargs):
+        """Move blocks and wait until they have arrived.
+
+        Only the requested blocks are waited upon, so moves of
+        separate axes can run together.
+        """
+        wait = kwargs.pop("wait", True)
+        return self.run(self._move, args, kwargs, wait)
+
+    def cget(self, block):
+        """Read a block."""
+        return self.run(gen.cget, block)
+
+    def get_pv(self, name, **kwargs):
+        """Read a PV."""
+        return self.run(gen.get_pv, name, **kwargs)
+
+    def set_pv(self, name, value, **kwargs):
+        """Write a PV."""
+        return self.run(gen.set_pv, name, value, **kwargs)
+
+    def waitfor_move(self, *blocks):
+        """Wait for blocks to stop moving, or all blocks if none are given."""
+        return self.run(gen.waitfor_move, *blocks)
+
+    def waitfor(self, **kwargs):
+        """Wait using the same keywords as ``gen.waitfor``."""
+        return self.run(gen.waitfor, **kwargs)
+
+    def wait_until(self, test, poll=1.0, timeout=None):
+        """Wait until a condition on the instrument is met.
+
+        Parameters
+        ----------
+        test : function
+          A blocking function which returns True once the condition
+          has been met.
+        poll : float
+          The number of seconds between checks
+        timeout : float or None
+          Give up after this many seconds
+
+        Returns
+        -------
+        multiprocessing.pool.AsyncResult
+          A task whose result states whether the condition was met
+          before the timeout.
+
+        """
+        return self.run(wait_until, test, poll, timeout)
+
+    def setup_dae(self, mode):
+        """Put the DAE into the named mode, e.g. "event"."""
+        return self.run(getattr(self.instrument, "setup_dae_" + mode))
+
+    def measure(self, title, **kwargs):
+        """Take a measurement, with the same parameters as ``measure``."""
+        return self.run(self.instrument.measure, title, **kwargs)
+
+    def detector_on(self, powered=None, delay=True):
+        """Query or set the detector power."""
+        return self.run(self.instrument.detector_on, powered, delay)
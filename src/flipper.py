@@ -0,0 +1,222 @@
+"""Alternate a paused run between DAE periods.
+
+Polarised measurements record each spin state in its own DAE period.
+The run is paused whenever the spin state changes, so that no
+neutrons are recorded in the wrong period.  Every round trip to the
+DAE made while the run is paused costs beam time, so a
+:py:class:`PeriodCycle` plans the frame targets for the whole run in
+advance, keeps the paused window down to the period change, the spin
+flip and the resume, and records the beam lost in every cycle.
+
+"""
+from __future__ import division
+from logging import info
+from math import ceil, sqrt
+from time import time
+from .genie import gen
+
+
+class Step(object):
+    """A single spin state in a cycle.
+
+    Parameters
+    ----------
+    period : int
+      The DAE period which records this state
+    frames : int
+      The number of frames to collect in each cycle
+    label : str
+      A message to log when the state begins
+    action : function
+      Called, while the run is paused, to put the instrument into
+      this state.
+
+    """
+
+    def __init__(self, period, frames, label="", action=None):
+        self.period = period
+        self.frames = frames
+        self.label = label
+        self.action = action
+
+
+def split_frames(rates, frames, minimum=1):
+    """Share the frames of a cycle between spin states.
+
+    The error on a polarisation measured from the counts in each state
+    is smallest when every state is counted for a time proportional to
+    the inverse square root of its count rate.
+
+    Parameters
+    ----------
+    rates : list of float
+      The count rate per frame in each state
+    frames : int
+      The number of frames in the whole cycle
+    minimum : int
+      The fewest frames to give to any state
+
+    Returns
+    -------
+    list of int
+      The number of frames for each state
+
+    """
+    weights = [1 / sqrt(rate) if rate > 0 else 1.0 for rate in rates]
+    total = sum(weights)
+    return [max(minimum, int(round(frames * weight / total)))
+            for weight in weights]
+
+
+class PeriodCycle(object):
+    """Repeat a sequence of spin states until a run is complete.
+
+    Parameters
+    ----------
+    steps : list of Step
+      The states to visit in every cycle
+    clock : function
+      Returns the current time in seconds.  The lost beam is found
+      from the ratio of the paused and counting times, so any clock
+      which runs at a steady rate will do.
+
+    Attributes
+    ----------
+    cycles : list of dict
+      For every completed cycle, the ``frames`` requested, the number
+      of seconds spent ``paused`` and an estimate of the frames
+      ``lost`` while paused.
+
+    """
+
+    def __init__(self, steps, clock=time):
+        self.steps = steps
+        self.clock = clock
+        self.cycles = []
+        self._paused_at = None
+        self._frames = 0
+
+    @property
+    def frames_per_cycle(self):
+        """The number of frames requested in a full cycle."""
+        return sum([step.frames for step in self.steps])
+
+    def schedule(self, frames, start=0):
+        """Plan the frame targets needed to collect a number of frames.
+
+        Parameters
+        ----------
+        frames : int
+          The total number of frames needed in the run
+        start : int
+          The number of frames already collected
+
+        Returns
+        -------
+        list of tuple
+          The step and the total frame count at which it ends, for
+          every step in the order that they will be taken.
+
+        """
+        count = int(max(0, ceil((frames - start) / self.frames_per_cycle)))
+        targets = []
+        total = start
+        for _ in range(count):
+            for step in self.steps:
+                total += step.frames
+                targets.append((step, total))
+        return targets
+
+    def run(self, frames=None, uamps=None, cycles=None):
+        """Collect data in a paused run until the target is reached.
+
+        Parameters
+        ----------
+        frames : int
+          The number of frames to collect
+        uamps : float
+          The proton charge to collect.  This is only used if the
+          number of frames is not given.  The charge per frame is
+          measured over the first cycle and used to plan the rest.
+        cycles : int
+          Perform exactly this many cycles, regardless of the frames
+          or charge.
+
+        The run may be continued by calling this method again, which
+        adds to the record of completed cycles.
+
+        """
+        self._paused_at = self.clock()
+        self._frames = gen.get_frames()
+        if cycles is not None:
+            self._perform(self.schedule(
+                self._frames + cycles * self.frames_per_cycle,
+                self._frames))
+            return
+        if frames is not None:
+            self._perform(self.schedule(frames, self._frames))
+            return
+        charge = gen.get_uamps()
+        per_frame = None
+        while charge < uamps:
+            if per_frame:
+                needed = self._frames + (uamps - charge) / per_frame
+                plan = self.schedule(needed, self._frames)
+            else:
+                plan = self.schedule(self._frames + 1, self._frames)
+            start_frames, start_charge = self._frames, charge
+            self._perform(plan)
+            self._frames = gen.get_frames()
+            charge = gen.get_uamps()
+            if self._frames > start_frames and charge > start_charge:
+                per_frame = (charge - start_charge) / \
+                    (self._frames - start_frames)
+
+    def _perform(self, plan):
+        """Take the planned steps, recording the time spent paused."""
+        cycle = {"frames": 0, "paused": 0.0, "counting": 0.0}
+        for index, (step, target) in enumerate(plan):
+            gen.change(period=step.period)
+            if step.action:
+                step.action()
+            if step.label:
+                info(step.label)
+            gen.resume()
+            resumed = self.clock()
+            cycle["paused"] += resumed - self._paused_at
+            gen.waitfor(frames=target)
+            gen.pause()
+            self._paused_at = self.clock()
+            cycle["counting"] += self._paused_at - resumed
+            cycle["frames"] += target - self._frames
+            self._frames = target
+            if (index + 1) % len(self.steps) == 0:
+                self._record(cycle)
+                cycle = {"frames": 0, "paused": 0.0, "counting": 0.0}
+
+    def _record(self, cycle):
+        counting = cycle.pop("counting")
+        if counting > 0:
+            cycle["lost"] = cycle["frames"] * cycle["paused"] / counting
+        else:
+            cycle["lost"] = 0.0
+        self.cycles.append(cycle)
+
+    def summary(self):
+        """Total the overheads over every completed cycle.
+
+        Returns
+        -------
+        dict
+          The number of ``cycles``, the ``frames`` requested, the
+          ``paused`` seconds, the estimated ``lost`` frames and the
+          ``efficiency``, which is the fraction of the beam that was
+          recorded.
+
+        """
+        result = {"cycles": len(self.cycles)}
+        for key in ["frames", "paused", "lost"]:
+            result[key] = sum([cycle[key] for cycle in self.cycles])
+        total = result["frames"] + result["lost"]
+        result["efficiency"] = result["frames"] / total if total else 1.0
+        return result
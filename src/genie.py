@@ -6,9 +6,15 @@ when it does not.  You can directly import this mock instrument by
 importing `mock_gen`.
 
 """
+from contextlib import contextmanager
+from fnmatch import fnmatch
+from threading import RLock, local
+from time import time
 import mock
 mock_gen = mock.Mock()
 mock_gen.mock_state = "SETUP"
+mock_gen.mock_clock = 0.0
+mock_gen.mock_pvs = {}
 
 
 def begin(*_, **_kwargs):
@@ -20,13 +26,16 @@ def begin(*_, **_kwargs):
 def end():
     """Fake stopping a measurement"""
     mock_gen.mock_state = "SETUP"
+    mock_gen.mock_run_number += 1
 
 
 MOTORS = {"CoarseZ": 0, "Translation": 0, "SampleX": 0,
           "SamplePos": "", "T0Phase": 0, "TargetDiskPhase": 0,
           "InstrumentDiskPhase": 0, "m4trans": 0,
           "Julabo1_SP": 0, "a1hgap": 0, "a1vgap": 0,
-          "s1hgap": 0, "s1vgap": 0}
+          "s1hgap": 0, "s1vgap": 0, "cjhgap": 0, "cjvgap": 0,
+          "bench_rot": 0, "benchlift": 0, "Coil1": 0, "Coil2": 0,
+          "BSY": 200.0, "BSZ": 0.0, "Analyser": 0}
 
 
 def cset_sideffect(axis=None, value=None, **kwargs):
@@ -42,6 +51,8 @@ def cset_sideffect(axis=None, value=None, **kwargs):
 mock_gen.begin.side_effect = begin
 mock_gen.end.side_effect = end
 mock_gen.get_runstate.side_effect = lambda: mock_gen.mock_state
+mock_gen.mock_run_number = 1000
+mock_gen.get_runnumber.side_effect = lambda: str(mock_gen.mock_run_number)
 mock_gen.cset.side_effect = cset_sideffect
 mock_gen.cget.side_effect = lambda axis: MOTORS[axis]
 
@@ -53,10 +64,17 @@ mock_gen.mock_sample_pars = {
 mock_gen.get_sample_pars.side_effect = lambda: mock_gen.mock_sample_pars
 mock_gen.get_frames = lambda: mock_gen.mock_frames
 mock_gen.get_uamps = lambda: mock_gen.mock_frames/900.0
+mock_gen.get_totalcounts.side_effect = lambda: 50.0 * mock_gen.mock_frames
+# The second period sees half the count rate of the first
+mock_gen.integrate_spectrum.side_effect = \
+    lambda spectrum, period=1, **_: 100.0 * mock_gen.mock_frames / period
 
 
 def waitfor(**kwargs):
-    """Update frames in response to waiting."""
+    """Update frames and the clock in response to waiting."""
+    for key, scale in [("seconds", 1), ("minutes", 60), ("hours", 3600)]:
+        if key in kwargs:
+            mock_gen.mock_clock += kwargs[key] * scale
     if "frames" in kwargs:
         mock_gen.mock_frames = max(mock_gen.mock_frames, kwargs["frames"])
     elif "uamps" in kwargs:
@@ -74,31 +92,49 @@ mock_gen.waitfor.side_effect = waitfor
 
 def change_sample_pars(key, value):
     """Fake change the sample parameters."""
-    if key.upper() == "THICK":
-        mock_gen.mock_sample_pars["THICK"] = value
+    mock_gen.mock_sample_pars[key.upper()] = value
 
 
 mock_gen.change_sample_par.side_effect = change_sample_pars
 
 
-def set_pv(pv_name, value):
+def set_pv(pv_name, value, *_args, **_kwargs):
     """Fake setting a PV value"""
     if "pwonoff" in pv_name:
         mock_gen.mock_detector_on = value
+    mock_gen.mock_pvs[pv_name] = value
 
 
-def get_pv(pv_name):
+def get_pv(pv_name, **_kwargs):
     """Fake getting a PV value"""
+    if pv_name.startswith("CS:SB:") and pv_name.endswith(":SP:RBV"):
+        return MOTORS[pv_name[len("CS:SB:"):-len(":SP:RBV")]]
     if "hv0" in pv_name:
         if mock_gen.mock_detector_on == "On":
             return "On"
         return "Off"
+    if "BENCH: STATUS" in pv_name:
+        return MOTORS["benchlift"]
+    if "BEAM:CURR" in pv_name:
+        return mock_gen.mock_beam_current
+    if pv_name in mock_gen.mock_pvs:
+        return mock_gen.mock_pvs[pv_name]
     return mock_gen.mock_get_pv(pv_name)
 
 
+def snapshot(blocks, pvs):
+    """Fake reading many blocks and PVs in one request"""
+    values = dict([(block, MOTORS[block]) for block in blocks])
+    values.update([(pv, get_pv(pv)) for pv in pvs])
+    return values
+
+
 mock_gen.get_pv.side_effect = get_pv
+mock_gen.snapshot.side_effect = snapshot
+mock_gen.get_blocks.side_effect = lambda: sorted(MOTORS)
 mock_gen.set_pv.side_effect = set_pv
 mock_gen.mock_detector_on = "On"
+mock_gen.mock_beam_current = 40.0
 
 try:
     import genie_python.genie as genie  # pylint: disable=unused-import
@@ -106,22 +142,250 @@ except ImportError:
     genie = mock_gen
 
 
+_THREAD = local()
+
+
 class SwitchGenie(object):
-    """A passthrough class that switches between a real and mock genie."""
+    """A passthrough class that switches between a real and mock genie.
+
+    Setting ``BACKEND`` to another genie-like object, such as a
+    :py:class:`src.simulation.SimulatedGenie`, sends all non-mocked
+    commands to that object instead of the real genie_python.  A
+    background thread can be held to a single genie with
+    :py:meth:`pinned`, so that it is not redirected when a dry run
+    changes ``MOCKING_MODE`` in another thread.
+    """
     MOCKING_MODE = False
+    BACKEND = None
 
     def __init__(self):
         pass
 
-    def __getattr__(self, name):
+    @staticmethod
+    def target():
+        """The genie object that currently receives the commands."""
+        pinned = getattr(_THREAD, "target", None)
+        if pinned is not None:
+            return pinned
         if SwitchGenie.MOCKING_MODE:
-            return getattr(mock_gen, name)
-        return getattr(genie, name)
+            return mock_gen
+        if SwitchGenie.BACKEND is not None:
+            return SwitchGenie.BACKEND
+        return genie
+
+    @staticmethod
+    @contextmanager
+    def pinned(target):
+        """Send this thread's commands to one genie object.
+
+        Parameters
+        ----------
+        target
+          The genie object, usually the result of :py:meth:`target`
+          in the thread which handed over the work.
+        """
+        previous = getattr(_THREAD, "target", None)
+        _THREAD.target = target
+        try:
+            yield target
+        finally:
+            _THREAD.target = previous
+
+    def __getattr__(self, name):
+        return getattr(SwitchGenie.target(), name)
 
     def __setattr__(self, name, value):
-        if SwitchGenie.MOCKING_MODE:
-            return setattr(mock_gen, name, value)
-        return setattr(genie, name, value)
+        return setattr(SwitchGenie.target(), name, value)
+
+
+class CachingGenie(object):
+    """A write-through cache in front of genie.
+
+    Every value written to a block, a journal PV, or a sample
+    parameter is remembered.  A write which would not change the
+    remembered value is skipped and reads of written PVs and of the
+    sample parameters are answered from memory.  All other calls pass
+    straight through to the backend.
+
+    Before a write is skipped, the value is read back from the
+    instrument, so a block which was moved by hand or a sample
+    parameter changed in the GUI is still sent the requested value.
+    Writes to any other PV may be commands (e.g. homing a motor), so
+    they are always sent, and they make the remembered block values
+    untrustworthy.
+
+    Each genie backend (real, mock, or simulated) is remembered
+    separately.  Values are forgotten after ``lifetime`` seconds, at
+    the start of each :py:func:`src.Util.user_script`, or whenever
+    :py:meth:`cache_clear` is called.  The cache may be used from
+    several threads at once.
+
+    """
+    lifetime = 3600.0
+    cached_pvs = ["*:PARS:SAMPLE:MEAS:*"]
+    _CSET_OPTIONS = ["runcontrol", "lowlimit", "highlimit", "wait",
+                     "verbose"]
+
+    def __init__(self, backend):
+        object.__setattr__(self, "_backend", backend)
+        object.__setattr__(self, "_stores", {})
+        object.__setattr__(self, "_lock", RLock())
 
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
 
-gen = SwitchGenie()
+    def __setattr__(self, name, value):
+        return setattr(self._backend, name, value)
+
+    def _store(self):
+        """The remembered values for the current genie."""
+        return self._stores.setdefault(SwitchGenie.target(), {})
+
+    def _recall(self, key):
+        """Find a remembered value.
+
+        Returns
+        -------
+        tuple
+          A boolean stating whether the value was known, followed by
+          the value itself.
+        """
+        with self._lock:
+            store = self._store()
+            if key in store:
+                stamp, value = store[key]
+                if time() - stamp < self.lifetime:
+                    return True, value
+                del store[key]
+        return False, None
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._store()[key] = (time(), value)
+
+    def _forget(self, key):
+        with self._lock:
+            self._store().pop(key, None)
+
+    def _unchanged(self, key, value):
+        known, old = self._recall(key)
+        return known and old == value
+
+    def _block_unchanged(self, block, value):
+        """Whether a block is already set to a value.
+
+        The remembered value is only trusted if the setpoint read back
+        from the instrument agrees with it.
+        """
+        if not self._unchanged(("block", block), value):
+            return False
+        try:
+            current = self._backend.get_pv(
+                "CS:SB:{}:SP:RBV".format(block), is_local=True)
+        except Exception:  # pylint: disable=broad-except
+            current = None
+        if current == value:
+            return True
+        self._forget(("block", block))
+        return False
+
+    def _pv_unchanged(self, key, value):
+        """Whether a journal PV already holds a value.
+
+        As with the blocks, the remembered value is only trusted if
+        the PV read back from the instrument agrees with it.
+        """
+        if not self._unchanged(key, value):
+            return False
+        _, name, is_local = key
+        try:
+            current = self._backend.get_pv(name, is_local=is_local)
+        except Exception:  # pylint: disable=broad-except
+            current = None
+        if current == value:
+            return True
+        self._forget(key)
+        return False
+
+    def cache_clear(self):
+        """Forget every remembered value."""
+        with self._lock:
+            self._stores.clear()
+
+    def cset(self, *args, **kwargs):
+        """Set blocks, skipping those already at the requested value."""
+        if len(args) == 2 and not kwargs:
+            block, value = args
+            if self._block_unchanged(block, value):
+                return None
+            result = self._backend.cset(block, value)
+            self._remember(("block", block), value)
+            return result
+        if args or [k for k in kwargs if k in self._CSET_OPTIONS]:
+            for block in list(args[:1]) + list(kwargs):
+                self._forget(("block", block))
+            return self._backend.cset(*args, **kwargs)
+        changed = {k: kwargs[k] for k in kwargs
+                   if not self._block_unchanged(k, kwargs[k])}
+        if not changed:
+            return None
+        result = self._backend.cset(**changed)
+        for block in changed:
+            self._remember(("block", block), changed[block])
+        return result
+
+    def set_pv(self, name, value, *args, **kwargs):
+        """Write a PV unless it is a journal PV which holds the value.
+
+        Only the PVs matching ``cached_pvs`` are remembered.  Every
+        other write is sent and forgets the remembered blocks.
+        """
+        if not [p for p in self.cached_pvs if fnmatch(name, p)]:
+            with self._lock:
+                store = self._store()
+                for key in [k for k in store if k[0] == "block"]:
+                    del store[key]
+            return self._backend.set_pv(name, value, *args, **kwargs)
+        key = ("pv", name, kwargs.get("is_local", False))
+        if self._pv_unchanged(key, value):
+            return None
+        result = self._backend.set_pv(name, value, *args, **kwargs)
+        self._remember(key, value)
+        return result
+
+    def get_pv(self, name, *args, **kwargs):
+        """Read a PV, using the last value written if there is one."""
+        known, value = self._recall(
+            ("pv", name, kwargs.get("is_local", False)))
+        if not known:
+            return self._backend.get_pv(name, *args, **kwargs)
+        if kwargs.get("to_string", False):
+            return str(value)
+        return value
+
+    def change_sample_par(self, key, value):
+        """Change a sample parameter if it differs from its current value
+
+        The parameters are read back from the instrument before a
+        write is skipped, in case they were changed elsewhere."""
+        known, pars = self._recall(("sample",))
+        if known and key.upper() in pars and pars[key.upper()] == value:
+            pars = dict(self._backend.get_sample_pars())
+            self._remember(("sample",), pars)
+            if key.upper() in pars and pars[key.upper()] == value:
+                return None
+        result = self._backend.change_sample_par(key, value)
+        if known:
+            pars[key.upper()] = value
+        return result
+
+    def get_sample_pars(self):
+        """Read the sample parameters, remembering them for next time"""
+        known, pars = self._recall(("sample",))
+        if not known:
+            pars = dict(self._backend.get_sample_pars())
+            self._remember(("sample",), pars)
+        return dict(pars)
+
+
+gen = CachingGenie(SwitchGenie())
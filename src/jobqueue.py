@@ -0,0 +1,296 @@
+"""A queue of measurements which can be changed while it runs.
+
+A :py:class:`MeasurementQueue` runs queued measurements one after
+another.  The queue lives in a directory on the instrument PC.
+Commands are given by dropping JSON files into the ``inbox``
+subdirectory, which :py:func:`submit` does for you.  They are read
+while a measurement is counting, so jobs can be added, reordered,
+reprioritised, or cancelled without ending the current run.  The
+whole queue is saved in ``queue.json`` after every change, so a
+restarted queue carries on where it left off.
+
+Every job is checked against the mock instrument just before it is
+run.  A job which fails its check, or whose measurement raises an
+error, is moved to the ``failed`` list of the queue with the error.
+
+The commands are
+
+append
+  Add a measurement.  ``kwargs`` holds the keyword arguments for
+  :py:meth:`src.Instrument.ScanningInstrument.measure` and
+  ``priority`` is optional.
+cancel
+  Remove the job with the given ``id``.
+priority
+  Give the job with the given ``id`` a new ``priority``.  Jobs with a
+  higher priority run first.
+move
+  Move the job with the given ``id`` to position ``index`` in the
+  queue.
+stop
+  Stop the queue once the current measurement is finished.
+
+"""
+import json
+import os
+from glob import glob
+from itertools import count
+from logging import info, warning
+from threading import Event, Lock, Thread
+from time import sleep, time
+import six
+
+_SUBMITTED = count()
+
+
+def _plain(value):
+    """Turn the unicode strings read from JSON into native strings."""
+    if isinstance(value, dict):
+        return {_plain(k): _plain(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    if six.PY2 and isinstance(value, six.text_type):
+        return value.encode("utf-8")
+    return value
+
+
+def _write_json(path, value):
+    """Replace a JSON file without leaving it half written."""
+    temporary = path + ".tmp"
+    with open(temporary, "w") as outfile:
+        json.dump(value, outfile, indent=2, sort_keys=True)
+    try:
+        os.rename(temporary, path)
+    except OSError:
+        # Windows will not rename over an existing file
+        os.remove(path)
+        os.rename(temporary, path)
+
+
+def submit(directory, command, **kwargs):
+    """Send a command to a measurement queue.
+
+    Parameters
+    ----------
+    directory : str
+      The directory of the queue
+    command : str
+      One of "append", "cancel", "priority", "move", or "stop"
+    **kwargs
+      The arguments of the command
+
+    Examples
+    --------
+
+    >>> submit(r"C:\\queue", "append", priority=1,
+    ...        kwargs={"title": "Sample", "pos": "AT", "uamps": 10})
+    >>> submit(r"C:\\queue", "cancel", id=3)
+
+    """
+    inbox = os.path.join(directory, "inbox")
+    if not os.path.isdir(inbox):
+        os.makedirs(inbox)
+    kwargs["command"] = command
+    name = "{:.6f}_{}_{}".format(time(), os.getpid(), next(_SUBMITTED))
+    path = os.path.join(inbox, name)
+    _write_json(path, kwargs)
+    os.rename(path, path + ".json")
+
+
+class MeasurementQueue(object):
+    """Run measurements from a queue that can change as it runs.
+
+    Parameters
+    ----------
+    directory : str
+      Where the queue is kept.  It is created if it does not exist.
+    measure : function
+      Called with the keyword arguments of every job
+    poll : float
+      The number of seconds between checks of the inbox
+    validate : function
+      Called with the keyword arguments of every job before it is
+      measured, and raises an error if the job cannot be run.
+
+    """
+    COMMANDS = ["append", "cancel", "priority", "move", "stop"]
+
+    def __init__(self, directory, measure, poll=1.0, validate=None):
+        self.directory = directory
+        self.measure = measure
+        self.validate = validate
+        self.poll = poll
+        self.jobs = []
+        self.failed = []
+        self.current = None
+        self.next_id = 1
+        self._stopping = False
+        self._lock = Lock()
+        self._inbox = os.path.join(directory, "inbox")
+        self._state = os.path.join(directory, "queue.json")
+        if not os.path.isdir(self._inbox):
+            os.makedirs(self._inbox)
+        self._load()
+
+    def _load(self):
+        """Recover the queue saved by an earlier session."""
+        if not os.path.exists(self._state):
+            return
+        with open(self._state, "r") as infile:
+            state = _plain(json.load(infile))
+        self.jobs = state["jobs"]
+        self.failed = state.get("failed", [])
+        self.next_id = state["next_id"]
+        if state["current"]:
+            warning("Job {} was interrupted and will be run again".format(
+                state["current"]["id"]))
+            self.jobs.insert(0, state["current"])
+        if self.jobs:
+            info("Recovered {} queued jobs".format(len(self.jobs)))
+
+    def _save(self):
+        _write_json(self._state, {"jobs": self.jobs,
+                                  "current": self.current,
+                                  "failed": self.failed,
+                                  "next_id": self.next_id})
+
+    def _find(self, job_id):
+        for job in self.jobs:
+            if job["id"] == job_id:
+                return job
+        raise KeyError("There is no queued job {}".format(job_id))
+
+    def append(self, kwargs, priority=0):
+        """Add a measurement to the end of the queue.
+
+        Returns
+        -------
+        int
+          The id of the new job
+
+        """
+        job = {"id": self.next_id, "priority": priority, "kwargs": kwargs}
+        self.next_id += 1
+        self.jobs.append(job)
+        info("Queued job {} ({}) with priority {}".format(
+            job["id"], kwargs.get("title", ""), priority))
+        return job["id"]
+
+    def cancel(self, id):  # pylint: disable=redefined-builtin
+        """Remove a job from the queue."""
+        self.jobs.remove(self._find(id))
+        info("Cancelled job {}".format(id))
+
+    def priority(self, id, priority):  # pylint: disable=redefined-builtin
+        """Change the priority of a job."""
+        self._find(id)["priority"] = priority
+        info("Job {} now has priority {}".format(id, priority))
+
+    def move(self, id, index):  # pylint: disable=redefined-builtin
+        """Move a job to a new place in the queue."""
+        job = self._find(id)
+        self.jobs.remove(job)
+        self.jobs.insert(index, job)
+        info("Moved job {} to place {}".format(id, index))
+
+    def stop(self):
+        """Stop once the current measurement is finished."""
+        self._stopping = True
+        info("The queue will stop after the current measurement")
+
+    def pending(self):
+        """The queued jobs in the order that they will run."""
+        return sorted(self.jobs, key=lambda job: -job["priority"])
+
+    def check_inbox(self):
+        """Perform every command waiting in the inbox."""
+        with self._lock:
+            changed = False
+            for path in sorted(glob(os.path.join(self._inbox, "*.json"))):
+                try:
+                    with open(path, "r") as infile:
+                        kwargs = _plain(json.load(infile))
+                    command = kwargs.pop("command")
+                    if command not in self.COMMANDS:
+                        raise ValueError("Unknown command " + command)
+                    getattr(self, command)(**kwargs)
+                    os.remove(path)
+                    changed = True
+                except Exception as err:  # pylint: disable=broad-except
+                    warning("Cannot perform {}: {}".format(
+                        os.path.basename(path), err))
+                    os.rename(path, path + ".bad")
+            if changed:
+                self._save()
+
+    def _watch(self, finished):
+        """Keep reading the inbox until the queue finishes."""
+        while not finished.wait(self.poll):
+            self.check_inbox()
+
+    def run(self, forever=True):
+        """Perform the queued measurements.
+
+        Parameters
+        ----------
+        forever : bool
+          If True, wait for more jobs when the queue is empty.
+          Otherwise, return once the queue is empty.
+
+        A job which fails its check is skipped.  An error during a
+        measurement stops the queue and is raised once the job has
+        been marked as failed.
+
+        """
+        self._stopping = False
+        finished = Event()
+        watcher = Thread(target=self._watch, args=(finished,))
+        watcher.daemon = True
+        watcher.start()
+        try:
+            while True:
+                self.check_inbox()
+                with self._lock:
+                    if self._stopping:
+                        break
+                    pending = self.pending()
+                    if pending:
+                        self.current = pending[0]
+                        self.jobs.remove(self.current)
+                        self._save()
+                if not pending:
+                    if not forever:
+                        break
+                    sleep(self.poll)
+                    continue
+                self._perform(self.current)
+                with self._lock:
+                    self.current = None
+                    self._save()
+        finally:
+            finished.set()
+            watcher.join()
+
+    def _fail(self, job, err):
+        """Move the current job to the failed list."""
+        with self._lock:
+            job["error"] = str(err)
+            self.failed.append(job)
+            self.current = None
+            self._save()
+
+    def _perform(self, job):
+        if self.validate is not None:
+            try:
+                self.validate(**job["kwargs"])
+            except Exception as err:  # pylint: disable=broad-except
+                warning("Job {} failed its check: {}".format(job["id"], err))
+                self._fail(job, err)
+                return
+        info("Starting job {}".format(job["id"]))
+        try:
+            self.measure(**job["kwargs"])
+        except Exception as err:
+            warning("Job {} failed: {}".format(job["id"], err))
+            self._fail(job, err)
+            raise
@@ -0,0 +1,429 @@
+"""Tools for loading and arranging a list of measurements.
+
+A plan is a list of dictionaries, each of which holds the keyword
+arguments for a single call to
+:py:meth:`src.Instrument.ScanningInstrument.measure`.  Plans are
+normally loaded from a CSV file by
+:py:meth:`src.Instrument.ScanningInstrument.measure_file`.
+
+A plan may keep a checkpoint file, which records each completed row
+and the runs it produced, so that an interrupted plan can be resumed
+without repeating those rows.
+
+Blocks which take time to equilibrate, such as a bath temperature,
+can be given a :py:class:`Settle` condition, so that
+:py:func:`run_plan` measures other samples while they settle.
+
+"""
+from __future__ import division
+import ast
+import csv
+import json
+import os
+from logging import info, warning
+from .genie import gen
+from .Util import block_value, snapshot
+
+
+def load_plan(file_path):
+    """Read a plan from a CSV file.
+
+    Parameters
+    ----------
+    file_path : str
+      The location of the CSV file.  The first line gives the names
+      of the keyword arguments and every other line is a measurement.
+
+    Returns
+    -------
+    list
+      A dictionary of keyword arguments for every measurement.  Blank
+      cells are left out, so that the keyword takes its default.
+
+    """
+    rows = []
+    with open(file_path, "rb") as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            for k in row.keys():
+                if row[k].strip() == "":
+                    del row[k]
+                elif row[k].upper() == "TRUE":
+                    row[k] = True
+                elif row[k].upper() == "FALSE":
+                    row[k] = False
+                else:
+                    try:
+                        row[k] = ast.literal_eval(row[k])
+                    except ValueError:
+                        continue
+            rows.append(row)
+    return rows
+
+
+def read_checkpoint(path, journal=None):
+    """Find the rows of a plan which have already been measured.
+
+    Parameters
+    ----------
+    path : str
+      The checkpoint file.  A missing file means that nothing has been
+      measured.
+    journal : str
+      The location of the journal XML file.  If given, a row only
+      counts as measured if every one of its runs is in the journal.
+
+    Returns
+    -------
+    dict
+      The run numbers produced by every completed row, keyed by the
+      position of the row in the plan.
+
+    """
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "r") as infile:
+        for line in infile:
+            if line.strip():
+                entry = json.loads(line)
+                done[entry["row"]] = entry["runs"]
+    if journal is None:
+        return done
+    from xml.etree import ElementTree as ET
+    from .reduction import SCHEMA, get_run_number
+    known = set([get_run_number(run) for run in ET.parse(journal).findall(
+        "./{}NXentry".format(SCHEMA))])
+    for row in sorted(done):
+        missing = [run for run in done[row] if run not in known]
+        if missing:
+            warning("Row {} will be measured again, as run {} is not in "
+                    "the journal".format(row + 1, missing[0]))
+            del done[row]
+    return done
+
+
+def write_checkpoint(path, row, title, runs, state=None):
+    """Record a completed row of a plan.
+
+    Parameters
+    ----------
+    path : str
+      The checkpoint file, which is appended to
+    row : int
+      The position of the row in the plan, counting from zero
+    title : str
+      The title of the measurement, to help people reading the file
+    runs : list of int
+      The run numbers which the row produced
+    state : dict
+      A snapshot of the instrument for the row, from
+      :py:func:`src.Util.snapshot`
+
+    """
+    entry = {"row": row, "title": title, "runs": runs}
+    if state:
+        entry["state"] = state
+    with open(path, "a") as outfile:
+        outfile.write(json.dumps(entry, sort_keys=True) + "\n")
+
+
+def _angle_changes(angles, start):
+    """Count the moves and total travel needed to visit a list of angles."""
+    moves = 0
+    travel = 0.0
+    current = start
+    for angle in angles:
+        if angle != current:
+            moves += 1
+            travel += abs(angle - current)
+            current = angle
+    return moves, travel
+
+
+def bench_order(rows, start=0.0, key="bench"):
+    """Group measurements by bench angle.
+
+    Parameters
+    ----------
+    rows : list
+      The plan to arrange.  Measurements without a bench angle are
+      taken at whichever angle was in use before them, and that angle
+      is written into their row so that reordering cannot move them.
+    start : float
+      The current bench angle.
+    key : str
+      The name of the bench angle keyword.
+
+    Returns
+    -------
+    rows : list
+      The plan with every measurement at the same angle run together.
+      The angles are visited in a single sweep, beginning at the end
+      of the range nearest to the starting angle.  Measurements at the
+      same angle keep their original order.
+    saved : int
+      The number of bench moves that have been avoided.
+    travel : float
+      The reduction in the total bench rotation, in degrees.
+
+    """
+    current = start
+    placed = []
+    for row in rows:
+        current = row.get(key, current)
+        row = dict(row)
+        row[key] = current
+        placed.append(row)
+    if not placed:
+        return [], 0, 0.0
+    angles = sorted(set([row[key] for row in placed]))
+    if abs(angles[-1] - start) < abs(angles[0] - start):
+        angles.reverse()
+    ordered = [row for angle in angles
+               for row in placed if row[key] == angle]
+    old_moves, old_travel = _angle_changes([r[key] for r in placed], start)
+    new_moves, new_travel = _angle_changes([r[key] for r in ordered], start)
+    return ordered, old_moves - new_moves, old_travel - new_travel
+
+
+def ramp_time(tunes, start, rates=None):
+    """The time needed to step through a sequence of settings.
+
+    Parameters
+    ----------
+    tunes : list of dict
+      The block values of each setting, in the order they are visited.
+      Keys which are not in ``start`` are ignored.
+    start : dict
+      The current value of every block
+    rates : dict
+      The speed of each block in units per second.  Blocks which are
+      not listed move at one unit per second.
+
+    Returns
+    -------
+    float
+      The number of seconds spent ramping, assuming that all of the
+      blocks in a setting move together.
+
+    """
+    if rates is None:
+        rates = {}
+    total = 0.0
+    current = dict(start)
+    for tune in tunes:
+        steps = [abs(tune[block] - current[block]) / rates.get(block, 1.0)
+                 for block in current if block in tune]
+        total += max(steps + [0.0])
+        current.update([(block, tune[block]) for block in current
+                        if block in tune])
+    return total
+
+
+def tune_order(tunes, start, rates=None):
+    """Order settings to reduce the time spent ramping between them.
+
+    Parameters
+    ----------
+    tunes : list of dict
+      The settings to visit
+    start : dict
+      The current value of every block
+    rates : dict
+      The speed of each block, as in :py:func:`ramp_time`
+
+    Returns
+    -------
+    list of dict
+      The settings, each visited by moving to the nearest remaining
+      setting.
+
+    """
+    remaining = list(tunes)
+    ordered = []
+    current = dict(start)
+    while remaining:
+        nearest = min(remaining,
+                      key=lambda tune: ramp_time([tune], current, rates))
+        remaining.remove(nearest)
+        ordered.append(nearest)
+        current.update([(block, nearest[block]) for block in current
+                        if block in nearest])
+    return ordered
+
+
+class Settle(object):
+    """A sample environment block which needs time to equilibrate.
+
+    Parameters
+    ----------
+    block : str
+      The setpoint block, e.g. "Julabo1_SP"
+    readback : str
+      The block which reports the value actually reached.  This
+      defaults to the setpoint itself.
+    tolerance : float
+      The largest difference between the readback and the setpoint
+      that counts as stable
+    hold : float
+      The number of seconds for which the readback must stay within
+      the tolerance
+    positions : list of str
+      The sample changer positions which feel the block.  If None,
+      every position is affected.
+    timeout : float
+      The longest time, in seconds, to wait for the block to settle
+      once there is nothing else to measure
+    poll : float
+      The time, in seconds, between checks of the readback
+
+    """
+
+    def __init__(self, block, readback=None, tolerance=0.1, hold=60.0,
+                 positions=None, timeout=3600.0, poll=10.0):
+        self.block = block
+        self.readback = readback or block
+        self.tolerance = tolerance
+        self.hold = hold
+        self.positions = positions
+        self.timeout = timeout
+        self.poll = poll
+        self.target = None
+        self._stable = 0.0
+        self._checked = None
+
+    def affects(self, row):
+        """Whether a measurement depends upon the block.
+
+        Measurements which set the block, or which do not give a
+        sample position, are always affected.
+        """
+        if self.block in row or self.positions is None:
+            return True
+        pos = row.get("pos")
+        return not isinstance(pos, str) or pos in self.positions
+
+    def change(self, value):
+        """Move the setpoint and start timing the equilibration."""
+        from .Util import instrument_time
+        info("Setting {} to {} and measuring elsewhere while it "
+             "settles".format(self.block, value))
+        gen.cset(self.block, value)
+        self.target = value
+        self._stable = 0.0
+        self._checked = instrument_time()
+
+    def _within(self):
+        try:
+            return abs(block_value(self.readback) - self.target) <= \
+                self.tolerance
+        except Exception:  # pylint: disable=broad-except
+            warning("Cannot read {}, assuming it is stable".format(
+                self.readback))
+            return True
+
+    def settled(self, waited=0.0):
+        """Check whether the block has been stable for long enough.
+
+        Parameters
+        ----------
+        waited : float
+          Seconds spent waiting since the last check, which are
+          added to the clock in case the clock does not follow the
+          waiting (e.g. in a dry run).
+
+        """
+        from .Util import instrument_time
+        now = instrument_time()
+        if self._within():
+            self._stable += max(now - self._checked, waited)
+        else:
+            self._stable = 0.0
+        self._checked = now
+        return self._stable >= self.hold
+
+    def wait(self):
+        """Wait until the block is stable or the timeout is reached.
+
+        Returns
+        -------
+        bool
+          Whether the block settled
+        """
+        waited = 0.0
+        step = 0.0
+        while not self.settled(step):
+            if waited >= self.timeout:
+                warning("{} did not settle at {} within {}s".format(
+                    self.block, self.target, self.timeout))
+                return False
+            step = min(self.poll, self.hold - self._stable,
+                       self.timeout - waited)
+            gen.waitfor(seconds=step)
+            waited += step
+        return True
+
+
+def run_plan(rows, measure, conditions=None):
+    """Perform a plan, measuring elsewhere while blocks equilibrate.
+
+    When a measurement changes a block with a settle condition, the
+    setpoint is moved at once, but the measurement waits until the
+    block is stable.  Meanwhile, the measurements which are not
+    affected by the block are taken in their original order.  The plan
+    returns to the waiting measurements as soon as the block settles.
+    Without any settle conditions, this is a plain loop over the plan.
+
+    Parameters
+    ----------
+    rows : list
+      The keyword arguments for each measurement
+    measure : function
+      Called with the keyword arguments of each measurement
+    conditions : list of Settle
+      The blocks which need time to equilibrate
+
+    """
+    conditions = list(conditions or [])
+    current = snapshot([condition.block for condition in conditions])
+    for condition in conditions:
+        condition.target = current[condition.block]
+    pending = list(rows)
+    settling = []
+    while pending:
+        for row in pending:
+            if _ready(row, conditions, settling):
+                pending.remove(row)
+                measure(**row)
+                break
+        else:
+            condition = settling.pop(0)
+            if condition.wait():
+                info("{} has settled at {}".format(condition.block,
+                                                   condition.target))
+
+
+def _ready(row, conditions, settling):
+    """Whether a measurement can be taken now.
+
+    A measurement which needs a new value of a block that is not
+    already settling starts moving that block, and is not ready.
+    """
+    ready = True
+    for condition in conditions:
+        if condition in settling:
+            if condition.settled():
+                settling.remove(condition)
+                info("{} has settled at {}".format(condition.block,
+                                                   condition.target))
+            elif condition.affects(row):
+                ready = False
+                continue
+        if condition.block in row and row[condition.block] != \
+                condition.target:
+            if condition not in settling:
+                condition.change(row[condition.block])
+                settling.append(condition)
+            ready = False
+    return ready
@@ -0,0 +1,208 @@
+"""A live preview of the detector from its events.
+
+A :py:class:`DetectorPreview` histograms the detector ids of events
+into an image of the detector and a radial profile about the beam
+centre.  Events are added in chunks as they arrive, so the preview
+can be checked while the run is still counting and the memory used
+never grows beyond the image and a single chunk.
+
+The events can come from an :py:class:`EventStream`, which follows a
+raw file of detector ids as it grows, or from a NeXus event file with
+:py:class:`NexusEvents`.  Both only read the events which have
+arrived since they were last asked.
+
+"""
+from __future__ import division
+from logging import info
+
+
+class EventStream(object):
+    """Read the new detector ids from a growing binary file.
+
+    Parameters
+    ----------
+    path : str
+      A file of detector ids, one after another, which is appended to
+      as the run counts.
+    dtype : str
+      The numpy type of each id
+    chunk : int
+      The most events to read at once
+
+    """
+
+    def __init__(self, path, dtype="<u4", chunk=1 << 20):
+        import numpy as np
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.chunk = chunk
+        self.offset = 0
+
+    def chunks(self):
+        """Yield the events written since the last call, in chunks."""
+        import numpy as np
+        with open(self.path, "rb") as infile:
+            infile.seek(0, 2)
+            available = (infile.tell() - self.offset) // self.dtype.itemsize
+            infile.seek(self.offset)
+            while available > 0:
+                count = min(available, self.chunk)
+                ids = np.fromfile(infile, dtype=self.dtype, count=count)
+                self.offset += ids.nbytes
+                available -= len(ids)
+                yield ids
+
+
+class NexusEvents(object):
+    """Read the new detector ids from a NeXus event file.
+
+    This needs the h5py package.
+
+    Parameters
+    ----------
+    path : str
+      The location of the NeXus file
+    dataset : str
+      The path of the event ids within the file
+    chunk : int
+      The most events to read at once
+
+    """
+
+    def __init__(self, path, dataset="raw_data_1/detector_1_events/event_id",
+                 chunk=1 << 20):
+        self.path = path
+        self.dataset = dataset
+        self.chunk = chunk
+        self.offset = 0
+
+    def chunks(self):
+        """Yield the events written since the last call, in chunks."""
+        try:
+            import h5py
+        except ImportError:
+            raise RuntimeError("Reading NeXus files needs the h5py package")
+        with h5py.File(self.path, "r") as nexus:
+            ids = nexus[self.dataset]
+            while self.offset < len(ids):
+                end = min(len(ids), self.offset + self.chunk)
+                yield ids[self.offset:end]
+                self.offset = end
+
+
+class DetectorPreview(object):
+    """Histogram detector events into an image and a radial profile.
+
+    Parameters
+    ----------
+    shape : tuple of int
+      The number of tubes and the number of pixels along each tube.
+      Detector ids run along each tube in turn.
+    first : int
+      The detector id of the first pixel
+    pitch : tuple of float
+      The distance, in metres, between neighbouring tubes and between
+      neighbouring pixels in a tube
+    centre : tuple of float
+      The position of the beam on the detector, in metres from the
+      middle of the detector
+    bins : int
+      The number of bins in the radial profile
+
+    Attributes
+    ----------
+    events : int
+      The number of events which hit the detector
+    missed : int
+      The number of events whose ids are not on the detector
+
+    """
+
+    def __init__(self, shape, first=0, pitch=(1.0, 1.0), centre=(0.0, 0.0),
+                 bins=50):
+        import numpy as np
+        self.shape = tuple(shape)
+        self.first = first
+        self.counts = np.zeros(self.shape[0] * self.shape[1], dtype=np.int64)
+        self.events = 0
+        self.missed = 0
+        tube, pixel = np.indices(self.shape)
+        x = (tube - (self.shape[0] - 1) / 2) * pitch[0] - centre[0]
+        y = (pixel - (self.shape[1] - 1) / 2) * pitch[1] - centre[1]
+        radius = np.hypot(x, y).ravel()
+        self.edges = np.linspace(0, radius.max(), bins + 1)
+        self._ring = np.minimum(np.searchsorted(self.edges, radius,
+                                                side="right") - 1, bins - 1)
+        self._ring_pixels = np.bincount(self._ring, minlength=bins)
+
+    def add(self, ids):
+        """Histogram a chunk of detector ids."""
+        import numpy as np
+        ids = np.asarray(ids, dtype=np.int64) - self.first
+        hits = ids[(ids >= 0) & (ids < len(self.counts))]
+        self.counts += np.bincount(hits, minlength=len(self.counts))
+        self.events += len(hits)
+        self.missed += len(ids) - len(hits)
+
+    def update(self, source):
+        """Add every new event from a source.
+
+        Parameters
+        ----------
+        source : EventStream or NexusEvents
+          The events to read
+
+        Returns
+        -------
+        int
+          The number of events added
+
+        """
+        before = self.events + self.missed
+        for ids in source.chunks():
+            self.add(ids)
+        return self.events + self.missed - before
+
+    @property
+    def image(self):
+        """The counts in every pixel, indexed by tube and pixel."""
+        return self.counts.reshape(self.shape)
+
+    def radial(self):
+        """Find the average counts per pixel in rings about the beam.
+
+        Returns
+        -------
+        radius : array
+          The middle of each ring, in metres
+        counts : array
+          The average counts in a pixel of each ring
+
+        """
+        import numpy as np
+        total = np.bincount(self._ring, weights=self.counts,
+                            minlength=len(self._ring_pixels))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = total / self._ring_pixels
+        return (self.edges[1:] + self.edges[:-1]) / 2, mean
+
+    def summarise(self, title, frames=None):
+        """Log the state of the preview.
+
+        Parameters
+        ----------
+        title : str
+          The name of the measurement
+        frames : int
+          The frames counted so far.  If given, the count rate is
+          logged as well.
+
+        """
+        import numpy as np
+        radius, counts = self.radial()
+        peak = radius[np.nanargmax(counts)] if self.events else 0.0
+        message = "Preview of {}: {} events, brightest ring at {:.3f}m".format(
+            title, self.events, peak)
+        if frames:
+            message += ", {:.1f} events per frame".format(self.events / frames)
+        info(message)
@@ -0,0 +1,183 @@
+"""A quick look at the transmission of a run, without a full reduction.
+
+The transmission of a sample is the ratio of the transmission and
+incident monitors on the sample, divided by the same ratio on the
+blank.  :py:func:`transmission` finds it as a function of wavelength
+from the monitor spectra alone, which takes seconds instead of
+waiting for the reduction.  The spectra can be read from the DAE with
+:py:func:`live_spectra` or from a NeXus file with
+:py:func:`nexus_spectra`.
+
+A set of spectra is a dictionary which maps the spectrum number to a
+pair of numpy arrays: the edges of the time channels, in
+microseconds, and the counts in each channel.
+
+"""
+from __future__ import division
+from logging import info, warning
+from .genie import gen
+
+# Angstrom metres per microsecond for a neutron (h / m_n)
+LAMBDA_PER_US = 3.956034e-3
+
+
+def live_spectra(spectra, period=1):
+    """Read monitor spectra from the current run.
+
+    Parameters
+    ----------
+    spectra : list of int
+      The spectrum numbers to read
+    period : int
+      The DAE period to read
+
+    """
+    import numpy as np
+    result = {}
+    for spectrum in spectra:
+        data = gen.get_spectrum(spectrum, period=period, dist=False)
+        edges = np.asarray(data["time"], dtype=float)
+        counts = np.asarray(data["signal"], dtype=float)
+        if len(edges) == len(counts):
+            # Only the centres were given, so put the edges half way
+            edges = np.concatenate([
+                [1.5 * edges[0] - 0.5 * edges[1]],
+                (edges[1:] + edges[:-1]) / 2,
+                [1.5 * edges[-1] - 0.5 * edges[-2]]])
+        result[spectrum] = (edges, counts)
+    return result
+
+
+def nexus_spectra(path, spectra, period=1):
+    """Read monitor spectra from a NeXus file.
+
+    Only the requested period of each monitor is read from the file,
+    so that large files with many periods are not loaded into memory.
+    This needs the h5py package.
+
+    Parameters
+    ----------
+    path : str
+      The location of the NeXus file
+    spectra : list of int
+      The spectrum numbers of the monitors to read
+    period : int
+      The DAE period to read
+
+    """
+    import numpy as np
+    try:
+        import h5py
+    except ImportError:
+        raise RuntimeError("Reading NeXus files needs the h5py package")
+    result = {}
+    with h5py.File(path, "r") as nexus:
+        entry = nexus[list(nexus.keys())[0]]
+        for name in entry:
+            if not name.startswith("monitor_"):
+                continue
+            monitor = entry[name]
+            spectrum = int(np.ravel(monitor["spectrum_index"][()])[0])
+            if spectrum not in spectra:
+                continue
+            result[spectrum] = (
+                np.asarray(monitor["time_of_flight"][()], dtype=float),
+                np.asarray(monitor["data"][period - 1, 0, :], dtype=float))
+    missing = [x for x in spectra if x not in result]
+    if missing:
+        raise RuntimeError("There is no monitor for spectrum {} in {}".format(
+            missing[0], path))
+    return result
+
+
+def rebin(edges, counts, new_edges):
+    """Share counts between a new set of channels.
+
+    The counts are assumed to be spread evenly across each of the old
+    channels.
+
+    Parameters
+    ----------
+    edges : array
+      The edges of the old channels, in increasing order
+    counts : array
+      The counts in each old channel
+    new_edges : array
+      The edges of the new channels
+
+    """
+    import numpy as np
+    total = np.concatenate([[0.0], np.cumsum(counts)])
+    return np.diff(np.interp(new_edges, edges, total))
+
+
+def transmission(sample, blank, incident, transmitted, lengths, bins):
+    """Find the transmission of a sample against its blank.
+
+    Parameters
+    ----------
+    sample, blank : dict
+      The monitor spectra of the sample and blank runs
+    incident, transmitted : int
+      The spectrum numbers of the incident and transmission monitors
+    lengths : dict
+      The flight path, in metres, from the moderator to each monitor
+    bins : array
+      The edges of the wavelength bins in Angstroms
+
+    Returns
+    -------
+    wavelength : array
+      The centre of each wavelength bin
+    trans : array
+      The transmission in each bin
+    error : array
+      The statistical error on the transmission
+
+    """
+    import numpy as np
+    bins = np.asarray(bins, dtype=float)
+
+    def counts(spectra, spectrum):
+        """Monitor counts in the wavelength bins."""
+        edges, signal = spectra[spectrum]
+        return rebin(edges * LAMBDA_PER_US / lengths[spectrum], signal,
+                     bins)
+
+    parts = np.array([counts(spectra, spectrum)
+                      for spectra in [sample, blank]
+                      for spectrum in [transmitted, incident]])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        trans = parts[0] / parts[1] / (parts[2] / parts[3])
+        error = trans * np.sqrt(np.sum(1 / parts, axis=0))
+    return (bins[1:] + bins[:-1]) / 2, trans, error
+
+
+def summarise(title, wavelength, trans, error, low=0.05, high=1.05):
+    """Log the transmission of a sample.
+
+    A warning is given if the average transmission is outside of the
+    range from ``low`` to ``high``, which suggests that the sample is
+    missing, too thick, or not in the beam.
+
+    Returns
+    -------
+    float
+      The average transmission, weighted by the errors
+
+    """
+    import numpy as np
+    good = np.isfinite(trans) & np.isfinite(error) & (error > 0)
+    if not good.any():
+        warning("No counts to find the transmission of {}".format(title))
+        return float("nan")
+    weights = 1 / error[good] ** 2
+    mean = float(np.sum(trans[good] * weights) / np.sum(weights))
+    info("Transmission of {} is {:.3f} from {:.2f}A to {:.2f}A "
+         "(between {:.3f} and {:.3f})".format(
+             title, mean, wavelength[good][0], wavelength[good][-1],
+             np.min(trans[good]), np.max(trans[good])))
+    if not low <= mean <= high:
+        warning("The transmission of {} is suspicious.  Consider "
+                "measuring it again.".format(title))
+    return mean
@@ -1,11 +1,17 @@
 """This module automates the creation of reduction scripts from the run log."""
 
 from __future__ import print_function
+from copy import deepcopy
 from xml.etree import ElementTree as ET
 from collections import defaultdict
 
 SCHEMA = "{http://definition.nexusformat.org/schema/3.0}"
 
+# The journal holds at most 40 characters of measurement type, so the
+# types of a packed run are abbreviated.
+PACKED_KINDS = {"sans": "s", "blank": "b", "transmission": "t",
+                "blank_transmission": "bt"}
+
 
 def get_kind(run):
     """What type of measuremented was performed?"""
@@ -48,11 +54,93 @@ def get_echo_id(run):
     return run.find("./{}measurement_id".format(SCHEMA)).text.split(",")[0]
 
 
+def get_slices(run):
+    """Get the time slices of a kinetic measurement
+
+    Returns
+    =======
+    The units of the slices and a list of their boundaries, or None
+    if the run was not a kinetic measurement.
+    """
+    text = run.find("./{}measurement_id".format(SCHEMA)).text
+    if not text or not text.startswith("kinetic:"):
+        return None
+    _, units, lengths = text.split(":")
+    boundaries = [0.0]
+    for group in lengths.split(","):
+        length, _, count = group.partition("*")
+        for _ in range(int(count) if count else 1):
+            boundaries.append(boundaries[-1] + float(length))
+    return units, boundaries
+
+
+def get_spin_states(run):
+    """Get the spin state of each period of a polarised measurement
+
+    Returns
+    =======
+    A list of the spin state labels, where the first label belongs
+    to period 1, or None if the run was not a polarised measurement.
+    """
+    text = run.find("./{}measurement_id".format(SCHEMA)).text
+    if not text or not text.startswith("spin:"):
+        return None
+    return text[len("spin:"):].split(",")
+
+
 def get_run_number(run):
     """Get the run number for the measurement"""
     return int(run.attrib["name"][len("LARMOR"):])
 
 
+def get_entry(run):
+    """Get the data to load for the measurement
+
+    This is the run number, or a tuple of the run number and the
+    period for a measurement from a single period of a packed run."""
+    if "period" in run.attrib:
+        return get_run_number(run), int(run.attrib["period"])
+    return get_run_number(run)
+
+
+def expand_periods(runs):
+    """Split packed runs into a separate entry for each period
+
+    Parameters
+    ==========
+    runs : list
+      A list of XML nodes for the runs
+
+    Returns
+    =======
+    A list of XML nodes where each run whose measurement label lists
+    several measurements, separated by "|", has been replaced by one
+    node per period.  Each of these has a ``period`` attribute and the
+    label, type, and id of its own measurement.  The abbreviated
+    types in ``PACKED_KINDS`` are written out in full.
+    """
+    fields = ["measurement_label", "measurement_type", "measurement_id"]
+    kinds = {PACKED_KINDS[kind]: kind for kind in PACKED_KINDS}
+    result = []
+    for run in runs:
+        labels = run.find("./{}measurement_label".format(SCHEMA)).text
+        if "|" not in labels:
+            result.append(run)
+            continue
+        for index in range(len(labels.split("|"))):
+            part = deepcopy(run)
+            part.set("period", str(index + 1))
+            for field in fields:
+                node = part.find("./{}{}".format(SCHEMA, field))
+                values = node.text.split("|")
+                if len(values) > 1:
+                    node.text = values[index]
+            kind = part.find("./{}measurement_type".format(SCHEMA))
+            kind.text = kinds.get(kind.text, kind.text)
+            result.append(part)
+    return result
+
+
 def connect_samples(runs, test):
     """Group runs with the same sample
 
@@ -80,8 +168,8 @@ def sans_connection(start, end, path):
     """Connect the runs for a series of sesans measurements"""
     root = ET.parse(path)
     runs = root.findall("./{}NXentry".format(SCHEMA))
-    runs = [run for run in runs
-            if start <= get_run_number(run) < end]
+    runs = expand_periods([run for run in runs
+                           if start <= get_run_number(run) < end])
 
     # Identify Transmissions
     bts = connect_samples(runs, is_blank_transmission)
@@ -121,16 +209,16 @@ def sans_connection(start, end, path):
     final_dict = defaultdict(lambda: defaultdict(dict))
     for sample, blank in sample_blank_pairs:
         total = {}
-        total["Sample"] = [get_run_number(p)
+        total["Sample"] = [get_entry(p)
                            for p in sample_runs[sample]]
         if sample in trans and blank in bts:
-            total["P0Trans"] = [get_run_number(x) for x in bts[blank]]
-            total["Trans"] = [get_run_number(x)
+            total["P0Trans"] = [get_entry(x) for x in bts[blank]]
+            total["Trans"] = [get_entry(x)
                               for x in trans[sample]]
         echos = [get_echo_id(p) for p in sample_runs[sample]]
-        total["P0"] = [get_run_number(run) for run in runs
+        total["P0"] = [get_entry(run) for run in runs
                        if get_echo_id(run) in echos
-                       and get_sample(run) == blank]
+                       and get_sample(run) == blank and is_blank(run)]
         final_dict[sample][blank] = total
     return final_dict
 
@@ -139,8 +227,8 @@ def sesans_connection(start, end, path):
     """Connect the runs for a series of sesans measurements"""
     root = ET.parse(path)
     runs = root.findall("./{}NXentry".format(SCHEMA))
-    runs = [run for run in runs
-            if start <= get_run_number(run) < end]
+    runs = expand_periods([run for run in runs
+                           if start <= get_run_number(run) < end])
 
     # Identify Transmissions
     bts = connect_samples(runs, is_blank_transmission)
@@ -190,16 +278,17 @@ def sesans_connection(start, end, path):
         total = {}
         for sel in sample_runs[sample]:
             total[sel] = {}
-            total[sel]["Sample"] = [get_run_number(p)
+            total[sel]["Sample"] = [get_entry(p)
                                     for p in sample_runs[sample][sel]]
             if sample in trans and blank in bts:
-                total[sel]["P0Trans"] = [get_run_number(x) for x in bts[blank]]
-                total[sel]["Trans"] = [get_run_number(x)
+                total[sel]["P0Trans"] = [get_entry(x) for x in bts[blank]]
+                total[sel]["Trans"] = [get_entry(x)
                                        for x in trans[sample]]
             echos = [get_echo_id(p) for p in sample_runs[sample][sel]]
-            total[sel]["P0"] = [get_run_number(run) for run in runs
+            total[sel]["P0"] = [get_entry(run) for run in runs
                                 if get_echo_id(run) in echos
-                                and get_sample(run) == blank]
+                                and get_sample(run) == blank
+                                and is_blank(run)]
         final_dict[sample][blank] = total
     return final_dict
 
@@ -224,6 +313,37 @@ def sesans_reduction(outfile, data, pairs):
                     data[sample][pairs[sample]][sel]))
 
 
+def _load_runs(variable, command, runs, direct=None):
+    """Write the Mantid commands which load a set of runs
+
+    Parameters
+    ==========
+    variable : str
+      The name of the workspace made by adding the runs
+    command : str
+      The ISISCommandInterface function which takes the data
+    runs : list
+      The entries from the connected data
+    direct : int
+      The run number for the direct run of a transmission
+
+    Returns
+    =======
+    The commands, or None if the runs cannot be loaded together.  A
+    period of a packed run is loaded by itself, since AddRuns cannot
+    select periods.
+    """
+    direct = "" if direct is None else ",{}".format(direct)
+    if not [run for run in runs if isinstance(run, tuple)]:
+        return "{0} = AddRuns([{1}])\n{2}({0}{3})\n".format(
+            variable, ", ".join([str(run) for run in runs]), command, direct)
+    if len(runs) > 1:
+        return None
+    number, period = runs[0]
+    return "{}('{}'{}, {}={})\n".format(
+        command, number, direct, "period_t" if direct else "period", period)
+
+
 def sans_reduction(outfile, data, pairs, mask, direct):
     """Create a reduction script for sans data
 
@@ -254,18 +374,17 @@ def sans_reduction(outfile, data, pairs, mask, direct):
             if "Trans" not in runinfo:
                 out.write("#  Error: Missing transmission information\n")
                 continue
-            out.write("sample = AddRuns([{}])\nAssignSample(sample)\n".format(
-                ", ".join([str(run) for run in runinfo["Sample"]])))
-            out.write(
-                "trans = AddRuns([{}])\nTransmissionSample(trans,{})\n".format(
-                    ", ".join([str(run) for run in runinfo["Trans"]]),
-                    direct))
-            out.write("can = AddRuns([{}])\nAssignCan(can)\n".format(
-                ", ".join([str(run) for run in runinfo["P0"]])))
-            out.write(
-                "can_tr = AddRuns([{}])\nTransmissionCan(can_tr,{})\n".format(
-                    ", ".join([str(run) for run in runinfo["P0Trans"]]),
-                    direct))
+            commands = [
+                _load_runs("sample", "AssignSample", runinfo["Sample"]),
+                _load_runs("trans", "TransmissionSample", runinfo["Trans"],
+                           direct),
+                _load_runs("can", "AssignCan", runinfo["P0"]),
+                _load_runs("can_tr", "TransmissionCan", runinfo["P0Trans"],
+                           direct)]
+            if None in commands:
+                out.write("#  Error: Cannot add the periods of packed runs\n")
+                continue
+            out.write("".join(commands))
             out.write("WavRangeReduction(3, 9)\n")
 
 
@@ -0,0 +1,566 @@
+"""An in-process stand-in for the instrument control system.
+
+The mock genie in :py:mod:`src.genie` answers every command instantly,
+which makes it useless for judging how long a script will take on the
+beamline.  :py:class:`SimulatedGenie` follows the genie_python
+interface, but every PV access has a latency, every motor has a
+velocity and settling time, and every DAE change takes time to apply.
+Pointing :py:class:`src.genie.SwitchGenie` at a simulated instrument
+allows scripts to be benchmarked on any computer.
+
+>>> from src.genie import SwitchGenie
+>>> SwitchGenie.BACKEND = SimulatedGenie(speedup=100)  # doctest: +SKIP
+
+All of the durations are given in simulated seconds.  The ``speedup``
+parameter sets how many simulated seconds pass for every real second,
+so that hours of beamline time can be benchmarked in minutes.
+
+"""
+from fnmatch import fnmatch
+from threading import RLock
+import time
+from .genie import MOTORS
+
+#: The speed of each motor in units per second
+VELOCITIES = {"CoarseZ": 2.0, "Translation": 5.0, "SampleX": 2.0,
+              "m4trans": 10.0, "a1hgap": 1.0, "a1vgap": 1.0,
+              "s1hgap": 1.0, "s1vgap": 1.0, "cjhgap": 1.0, "cjvgap": 1.0,
+              "BSY": 2.0, "BSZ": 5.0, "bench_rot": 0.1,
+              "pol_trans": 5.0, "pol_arc": 0.01}
+
+#: The time, in seconds, for a block to settle after it stops moving
+SETTLE_TIMES = {"SamplePos": 15.0, "T0Phase": 20.0,
+                "TargetDiskPhase": 20.0, "InstrumentDiskPhase": 20.0,
+                "benchlift": 0.0}
+
+#: Blocks which exist on the simulated instrument beyond the mock ones
+EXTRA_BLOCKS = {"pol_trans": 0, "pol_arc": 0}
+
+#: The time, in seconds, needed for each DAE transition
+DAE_TIMES = {"begin": 5.0, "end": 10.0, "change": 5.0, "pause": 1.0,
+             "resume": 1.0, "period": 0.5, "flipper": 1.0}
+
+
+class Motor(object):
+    """A single simulated block.
+
+    Numeric blocks travel at a constant velocity and then settle.
+    Other blocks (e.g. the sample changer position) take the settling
+    time to reach their new value.
+
+    Parameters
+    ----------
+    value
+      The initial position of the block
+    velocity : float or None
+      The speed of the block in units per second.  If None, the block
+      jumps straight to its new value.
+    settle : float
+      The time to wait after the motion has finished.
+    """
+    def __init__(self, value, velocity=None, settle=0.0):
+        self.start = value
+        self.target = value
+        self.began = 0.0
+        self.velocity = velocity
+        self.settle = settle
+
+    def _travel(self):
+        if not self.velocity:
+            return 0.0
+        try:
+            return abs(self.target - self.start) / self.velocity
+        except TypeError:
+            return 0.0
+
+    def move(self, now, target):
+        """Send the block to a new position."""
+        self.start = self.position(now)
+        self.target = target
+        self.began = now
+
+    def finished(self):
+        """The simulated time when the block reaches its target."""
+        return self.began + self._travel() + self.settle
+
+    def position(self, now):
+        """The readback of the block at the given time."""
+        travel = self._travel()
+        if not travel:
+            if now >= self.finished():
+                return self.target
+            return self.start
+        if now >= self.began + travel:
+            return self.target
+        return self.start + (self.target - self.start) * \
+            (now - self.began) / travel
+
+
+class SimulatedGenie(object):  # pylint: disable=too-many-public-methods
+    """A genie_python replacement with realistic timings.
+
+    Parameters
+    ----------
+    speedup : float
+      The number of simulated seconds which pass in every real second.
+    latency : float
+      The default round trip time of a single channel access request.
+    pv_latency : dict
+      Latencies for individual PVs.  The keys are glob patterns which
+      are matched against the PV name.
+    frame_rate : float
+      The number of proton pulses per second.
+    pvs : dict
+      Initial values for the PVs on the instrument.
+
+    Writing to some PVs or blocks changes other PVs after a delay,
+    such as the detector status following its power switch.  These
+    are declared with :py:meth:`link`.
+
+    The monitor spectra count at ``count_rates`` per frame and every
+    other spectrum counts at ``detector_rate``.  If ``profile`` is set,
+    it is called with the position of every block and scales the
+    detector rate, which allows alignment scans to be simulated.
+
+    The proton beam gives a ``current`` of 40 microamps, except during
+    the ``outages``, a list of the simulated times at which the beam
+    trips and returns.
+
+    """
+    frames_per_uamp = 900.0
+    poll = 0.5
+
+    def __init__(self, speedup=1.0, latency=0.02, pv_latency=None,
+                 frame_rate=10.0, pvs=None):
+        self.speedup = float(speedup)
+        self.latency = latency
+        self.pv_latency = pv_latency if pv_latency else {}
+        self.frame_rate = frame_rate
+        self.dae_times = dict(DAE_TIMES)
+        self.count_rates = {1: 1000.0, 2: 1000.0, 3: 500.0, 4: 200.0}
+        self.detector_rate = 5000.0
+        self.profile = None
+        self.beam = True
+        self.current = 40.0
+        self.outages = []
+        self.calls = []
+        self._lock = RLock()
+        self._epoch = time.time()
+        self._pvs = {}
+        self._pending = []
+        self._links = []
+        self._blocks = {}
+        blocks = dict(MOTORS)
+        blocks.update(EXTRA_BLOCKS)
+        for name, value in blocks.items():
+            self._blocks[name] = Motor(value, VELOCITIES.get(name),
+                                       SETTLE_TIMES.get(name, 1.0))
+        self._state = "SETUP"
+        self._title = ""
+        self._run_number = 10000
+        self._nperiods = 1
+        self._period = 1
+        self._frames = {}
+        self._exposure = {}
+        self._last = 0.0
+        self._sample_pars = {"GEOMETRY": "Flat Plate", "WIDTH": 10,
+                             "HEIGHT": 10, "THICK": 1}
+        for inst, channels in [("LARMOR", ["0:8", "0:9", "0:10", "0:11"]),
+                               ("ZOOM", ["4:{}".format(x)
+                                         for x in range(8)])]:
+            for channel in channels:
+                stem = "IN:{}:CAEN:hv0:{}:".format(inst, channel)
+                self._pvs[stem + "status"] = "On"
+                self._pvs[stem + "pwonoff"] = "On"
+                self.link(stem + "pwonoff", stem + "status",
+                          lambda value: 120.0 if value == "On" else 45.0)
+        self._pvs["IN: LARMOR: BENCH: STATUS"] = 0
+        self.link("benchlift", "IN: LARMOR: BENCH: STATUS", 15.0)
+        if pvs:
+            self._pvs.update(pvs)
+
+    # Simulated time
+
+    def clock(self):
+        """The number of simulated seconds since the instrument started."""
+        return (time.time() - self._epoch) * self.speedup
+
+    def _sleep(self, seconds):
+        """Let a number of simulated seconds pass."""
+        if seconds > 0:
+            time.sleep(seconds / self.speedup)
+
+    def _round_trip(self, name):
+        """Pay the channel access latency for a named PV or block."""
+        self.calls.append((self.clock(), name))
+        latency = self.latency
+        for pattern in self.pv_latency:
+            if fnmatch(name, pattern):
+                latency = self.pv_latency[pattern]
+        self._sleep(latency)
+
+    # PVs
+
+    def link(self, source, target, delay, value=None):
+        """Make a write to one PV or block change another PV.
+
+        Parameters
+        ----------
+        source : str
+          The PV or block which is written
+        target : str
+          The PV which follows the write
+        delay : float or function
+          The number of seconds before the target changes.  If this is
+          a function, it is called with the written value.
+        value : function
+          Converts the written value into the target value.  By
+          default, the target takes the written value.
+        """
+        self._links.append((source, target, delay, value))
+
+    def _written(self, source, value):
+        now = self.clock()
+        for name, target, delay, convert in self._links:
+            if name != source:
+                continue
+            if callable(delay):
+                delay = delay(value)
+            result = convert(value) if convert else value
+            with self._lock:
+                self._pending.append((now + delay, target, result))
+
+    def _settle_pvs(self):
+        now = self.clock()
+        with self._lock:
+            ready = sorted([p for p in self._pending if p[0] <= now],
+                           key=lambda p: p[0])
+            self._pending = [p for p in self._pending if p[0] > now]
+            for _, target, value in ready:
+                self._pvs[target] = value
+
+    def get_pv(self, name, to_string=False, is_local=False):
+        """Read a PV."""
+        self._round_trip(name)
+        self._settle_pvs()
+        if name.endswith("BEAM:CURR"):
+            return self.beam_current()
+        if name.startswith("CS:SB:") and name.endswith(":SP:RBV"):
+            return self._block(name[len("CS:SB:"):-len(":SP:RBV")]).target
+        if name not in self._pvs:
+            raise RuntimeError("Unable to find PV {}".format(name))
+        if to_string:
+            return str(self._pvs[name])
+        return self._pvs[name]
+
+    def set_pv(self, name, value, wait=False, is_local=False):
+        """Write a PV."""
+        self._round_trip(name)
+        with self._lock:
+            self._pvs[name] = value
+        self._written(name, value)
+
+    # Blocks
+
+    def _block(self, name):
+        if name not in self._blocks:
+            raise RuntimeError("Unknown Block {}".format(name))
+        return self._blocks[name]
+
+    def cset(self, *args, **kwargs):
+        """Move one or more blocks."""
+        if len(args) == 2:
+            kwargs[args[0]] = args[1]
+        elif args:
+            kwargs[args[0]] = kwargs.pop("value")
+        for option in ["runcontrol", "lowlimit", "highlimit", "verbose"]:
+            kwargs.pop(option, None)
+        wait = kwargs.pop("wait", False)
+        for name in kwargs:
+            self._block(name)
+        for name in kwargs:
+            self._round_trip(name)
+            with self._lock:
+                self._blocks[name].move(self.clock(), kwargs[name])
+            self._written(name, kwargs[name])
+        if wait:
+            self.waitfor_move(*kwargs.keys())
+
+    def cget(self, block):
+        """Read the current state of a block."""
+        self._round_trip(block)
+        motor = self._block(block)
+        now = self.clock()
+        return {"name": block, "value": motor.position(now),
+                "connected": True, "runcontrol": "NO",
+                "lowlimit": None, "highlimit": None}
+
+    def get_blocks(self):
+        """The names of every block on the instrument."""
+        return sorted(self._blocks)
+
+    def snapshot(self, blocks, pvs):
+        """Read many blocks and PVs in a single round trip."""
+        self._round_trip("snapshot")
+        self._settle_pvs()
+        now = self.clock()
+        values = dict([(block, self._block(block).position(now))
+                       for block in blocks])
+        for name in pvs:
+            if name.endswith("BEAM:CURR"):
+                values[name] = self.beam_current()
+            elif name in self._pvs:
+                values[name] = self._pvs[name]
+            else:
+                raise RuntimeError("Unable to find PV {}".format(name))
+        return values
+
+    def waitfor_move(self, *blocks, **_kwargs):
+        """Wait until the blocks have stopped moving."""
+        names = blocks if blocks else list(self._blocks)
+        finish = max([self._blocks[b].finished() for b in names] + [0.0])
+        self._sleep(finish - self.clock())
+
+    # DAE
+
+    def _advance(self):
+        """Count the frames collected since the last update."""
+        with self._lock:
+            now = self.clock()
+            if self._state == "RUNNING":
+                frames = self._beam_time(self._last, now) * self.frame_rate
+                self._frames[self._period] = \
+                    self._frames.get(self._period, 0.0) + frames
+                if self.profile:
+                    frames *= self.profile(dict(
+                        [(name, motor.position(now))
+                         for name, motor in self._blocks.items()]))
+                self._exposure[self._period] = \
+                    self._exposure.get(self._period, 0.0) + frames
+            self._last = now
+
+    def _transition(self, kind, state=None):
+        self._round_trip("DAE")
+        self._advance()
+        self._sleep(self.dae_times[kind])
+        self._advance()
+        if state:
+            self._state = state
+
+    def _beam_time(self, start, stop):
+        """The number of seconds with beam between two times."""
+        if not self.beam:
+            return 0.0
+        total = stop - start
+        for off, on in self.outages:
+            total -= max(0.0, min(stop, on) - max(start, off))
+        return total
+
+    def beam_current(self):
+        """The simulated proton current in microamps."""
+        now = self.clock()
+        if self._beam_time(now, now + 1e-9) > 0:
+            return self.current
+        return 0.0
+
+    def set_beam(self, on):
+        """Switch the simulated proton beam on or off."""
+        self._advance()
+        self.beam = on
+
+    def get_runstate(self):
+        """The current state of the DAE."""
+        self._round_trip("DAE")
+        return self._state
+
+    def get_frames(self, period=None):
+        """The number of good frames in the run."""
+        self._round_trip("DAE")
+        self._advance()
+        if period:
+            return int(self._frames.get(period, 0))
+        return int(sum(self._frames.values()))
+
+    def get_uamps(self, period=None):
+        """The proton charge collected during the run."""
+        self._round_trip("DAE")
+        self._advance()
+        if period:
+            frames = self._frames.get(period, 0)
+        else:
+            frames = sum(self._frames.values())
+        return frames / self.frames_per_uamp
+
+    def get_period(self):
+        """The current DAE period."""
+        self._round_trip("DAE")
+        return self._period
+
+    def get_number_periods(self):
+        """The number of DAE periods."""
+        self._round_trip("DAE")
+        return self._nperiods
+
+    def get_runnumber(self):
+        """The number of the current run."""
+        self._round_trip("DAE")
+        return str(self._run_number)
+
+    def get_title(self):
+        """The title of the current run."""
+        self._round_trip("DAE")
+        return self._title
+
+    def integrate_spectrum(self, spectrum, period=1, t_min=None,
+                           t_max=None):
+        """The total counts in a spectrum."""
+        self._round_trip("DAE")
+        self._advance()
+        if spectrum in self.count_rates:
+            return self.count_rates[spectrum] * self._frames.get(period, 0.0)
+        return self.detector_rate * self._exposure.get(period, 0.0)
+
+    def get_spectrum(self, spectrum, period=1, t_min=None, t_max=None,
+                     dist=False):
+        """The counts in every time channel of a spectrum.
+
+        Every spectrum has the same shape in time of flight, scaled so
+        that it sums to :py:meth:`integrate_spectrum`.
+        """
+        import numpy as np
+        edges = np.arange(5.0, 100006.0, 100.0)
+        centres = (edges[1:] + edges[:-1]) / 2 / 15000.0
+        shape = centres ** 2 * np.exp(-centres ** 2)
+        signal = shape / shape.sum() * self.integrate_spectrum(
+            spectrum, period)
+        if dist:
+            signal = signal / np.diff(edges)
+        return {"time": list(edges), "signal": list(signal), "sum": None,
+                "mode": "distribution" if dist else "non-distribution"}
+
+    def get_totalcounts(self):
+        """The total number of detector counts in the run."""
+        self._round_trip("DAE")
+        self._advance()
+        return self.detector_rate * sum(self._exposure.values())
+
+    def begin(self, period=1, paused=False, **_kwargs):
+        """Start a run."""
+        if self._state != "SETUP":
+            raise RuntimeError("Cannot begin while {}".format(self._state))
+        self._frames = {}
+        self._exposure = {}
+        self._period = period
+        self._transition("begin", "PAUSED" if paused else "RUNNING")
+
+    def end(self, **_kwargs):
+        """Finish a run and write the data file."""
+        self._transition("end", "SETUP")
+        self._run_number += 1
+
+    def abort(self, **_kwargs):
+        """Throw away the current run."""
+        self._transition("pause", "SETUP")
+
+    def pause(self, **_kwargs):
+        """Pause the run."""
+        self._transition("pause", "PAUSED")
+
+    def resume(self, **_kwargs):
+        """Resume a paused run."""
+        self._transition("resume", "RUNNING")
+
+    def change(self, title=None, period=None, nperiods=None, **_kwargs):
+        """Change the run title or the DAE periods."""
+        if title is not None:
+            self._round_trip("DAE")
+            self._title = title
+        if nperiods is not None:
+            self._transition("change")
+            self._nperiods = nperiods
+        if period is not None:
+            self._transition("period")
+            self._period = period
+
+    def change_start(self):
+        """Begin a block of DAE changes."""
+        self._round_trip("DAE")
+
+    def change_finish(self):
+        """Apply a block of DAE changes."""
+        self._transition("change")
+
+    def change_tables(self, **_kwargs):
+        """Change the wiring, spectra, or detector tables."""
+        self._round_trip("DAE")
+
+    def change_tcb(self, **_kwargs):
+        """Change the time channel boundaries."""
+        self._round_trip("DAE")
+
+    def change_sync(self, _source):
+        """Change the DAE synchronisation source."""
+        self._round_trip("DAE")
+
+    def flipper1(self, _state):
+        """Change the state of the neutron spin flipper."""
+        self._round_trip("flipper1")
+        self._sleep(self.dae_times["flipper"])
+
+    # Sample parameters
+
+    def get_sample_pars(self):
+        """The sample parameters for the next run."""
+        self._round_trip("DAE")
+        return dict(self._sample_pars)
+
+    def change_sample_par(self, key, value):
+        """Change a sample parameter."""
+        self._round_trip("DAE")
+        self._sample_pars[key.upper()] = value
+
+    # Waiting
+
+    def _waiting(self, **kwargs):
+        """Has any of the waitfor conditions not yet been met?"""
+        if "frames" in kwargs and kwargs["frames"] is not None:
+            if sum(self._frames.values()) >= kwargs["frames"]:
+                return False
+        if "uamps" in kwargs and kwargs["uamps"] is not None:
+            if sum(self._frames.values()) / self.frames_per_uamp >= \
+               kwargs["uamps"]:
+                return False
+        if "block" in kwargs and kwargs["block"] is not None:
+            value = self._blocks[kwargs["block"]].position(self.clock())
+            if value == kwargs.get("value"):
+                return False
+            if kwargs.get("lowlimit") is not None and \
+               kwargs.get("highlimit") is not None and \
+               kwargs["lowlimit"] <= value <= kwargs["highlimit"]:
+                return False
+        return True
+
+    def waitfor(self, block=None, value=None, lowlimit=None, highlimit=None,
+                seconds=None, minutes=None, hours=None, frames=None,
+                uamps=None, **_kwargs):
+        """Wait until the first of the given conditions is met."""
+        limit = None
+        for count, scale in [(seconds, 1), (minutes, 60), (hours, 3600)]:
+            if count is not None:
+                limit = count * scale
+        start = self.clock()
+        while True:
+            self._advance()
+            if limit is not None and self.clock() - start >= limit:
+                return
+            if (frames is not None or uamps is not None or
+                    block is not None) and \
+                    not self._waiting(block=block, value=value,
+                                      lowlimit=lowlimit,
+                                      highlimit=highlimit,
+                                      frames=frames, uamps=uamps):
+                return
+            step = self.poll
+            if limit is not None:
+                step = min(step, limit - (self.clock() - start))
+            self._sleep(step)
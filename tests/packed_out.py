@@ -0,0 +1,12 @@
+from ISISCommandInterface import MaskFile, AddRuns, AssignSample, AssignCan
+from ISISCommandInterface import TransmissionSample, TransmissionCan
+from ISISCommandInterface import WavRangeReduction
+MaskFile('Mask.txt')
+#  Sample A
+sample = AddRuns([102])
+AssignSample(sample)
+TransmissionSample('100',85, period_t=2)
+can = AddRuns([101])
+AssignCan(can)
+TransmissionCan('100',85, period_t=1)
+WavRangeReduction(3, 9)